@@ -1,18 +1,61 @@
 import logging
-from fastapi import FastAPI
+import hmac
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.concurrency import asynccontextmanager
 from api.handler.endpoints import router
 from fastapi.middleware.cors import CORSMiddleware
 from api.config import settings
 from api.db.postgres import init_db
+from api.integration.pubsub import close_pubsub, init_pubsub, publish
+from api.integration.runpod import close_runpod, init_runpod
+from api.integration.s3 import close_s3, init_s3
+from api.integration.sqs import close_sqs, init_sqs
 
+from api.metrics import render_prometheus
 from api.middleware.jwt import JWTAuthMiddleware
+from api.middleware.metrics import MetricsMiddleware
+from api.services.connections import manager
+from api.services.imaging import close_imaging, init_imaging
+from api.services.ingest import ingestor
+from api.services.outbox import relay
+from api.services.reconciler import Reconciler
+from api.services.timeline import timeline
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.basicConfig(level=logging.INFO)
     await init_db()
+    await init_pubsub(manager.broadcast, settings.PUBSUB_BACKEND)
+    manager.start()
+    init_s3()
+    init_sqs()
+    init_imaging(settings.IMAGE_NORMALIZE, settings.IMAGE_NORMALIZE_WORKERS)
+    await init_runpod()
+    reconciler = Reconciler(
+        publish,
+        interval=settings.RECONCILER_INTERVAL,
+        min_poll=settings.RECONCILER_MIN_POLL,
+        max_poll=settings.RECONCILER_MAX_POLL,
+        concurrency=settings.RECONCILER_CONCURRENCY,
+        election_interval=settings.RECONCILER_ELECTION_INTERVAL,
+    )
+    if settings.RECONCILER_ENABLED:
+        reconciler.start()
+    timeline.start()
+    relay.start()
+    ingestor.start()
     yield
+    await ingestor.stop()
+    await relay.stop()
+    await reconciler.stop()
+    await timeline.stop()
+    await close_runpod()
+    await close_sqs()
+    close_imaging()
+    close_s3()
+    await manager.stop()
+    await close_pubsub()
 
 app = FastAPI(title="AI Image Generator",lifespan=lifespan)
 
@@ -22,7 +65,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Image-Metadata"],
+    expose_headers=["X-Image-Metadata", "X-Next-Cursor", "X-Total-Count", "ETag", "Content-Range"],
 )
 app.add_middleware(JWTAuthMiddleware)
+# outermost, so time spent in auth and CORS is part of the request latency
+app.add_middleware(MetricsMiddleware)
 app.include_router(router)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not settings.METRICS_PUBLIC:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not settings.METRICS_TOKEN or not hmac.compare_digest(
+                request.headers.get("authorization", "").encode(), expected.encode()):
+            return PlainTextResponse("unauthorized", status_code=401)
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
 
@@ -21,6 +21,92 @@ class Settings(BaseSettings):
     SIGNATURE_SECRET:str
     APP_BASE_URL:str
 
+    JWT_CACHE_SIZE: int = 4096
+    JWT_CACHE_MAX_TTL: float = 300.0
+    # optional claim the dispatcher uses to weight a user's share of the GPUs
+    JWT_TIER_CLAIM: str = "tier"
+
+    DB_POOL_MIN_SIZE: int = 10
+    DB_POOL_MAX_SIZE: int = 10
+
+    S3_MAX_POOL_CONNECTIONS: int = 32
+    S3_EXECUTOR_WORKERS: int = 16
+    S3_MULTIPART_CHUNK_SIZE: int = 8 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY: int = 2
+    S3_STREAM_CHUNK_SIZE: int = 64 * 1024
+
+    RUNPOD_CONNECT_TIMEOUT: float = 3.0
+    RUNPOD_READ_TIMEOUT: float = 10.0
+    RUNPOD_MAX_CONNECTIONS: int = 100
+    RUNPOD_STATUS_CACHE_TTL: float = 1.0
+
+    SQS_BATCH_WAIT: float = 0.005
+
+    DEFAULT_RESOLUTION: str = "512x512"
+    IMAGE_NORMALIZE: bool = False
+    IMAGE_NORMALIZE_WORKERS: int = 2
+
+    STATUS_IMAGE_DELIVERY: str = "proxy"
+    PRESIGNED_URL_TTL: int = 3600
+    PRESIGNED_URL_MIN_REMAINING: int = 300
+    PRESIGNED_URL_CACHE_SIZE: int = 10000
+
+    WORKFLOW_NAME: str = "img2img_flux"
+    RESULT_MEMOIZATION: bool = True
+    # reuse results across users: one user's submission could then finish with
+    # another's result and reveal that the same image and prompt were sent before
+    RESULT_MEMOIZATION_SHARED: bool = False
+
+    JOB_CACHE_SIZE: int = 10000
+    RESULT_CACHE_BYTES: int = 256 * 1024 * 1024
+    RESULT_CACHE_MAX_ITEM_BYTES: int = 8 * 1024 * 1024
+    RESULT_CACHE_DIR: Optional[str] = None
+
+    WEBHOOK_FLUSH_INTERVAL: float = 0.05
+    WEBHOOK_MAX_BATCH: int = 500
+    WEBHOOK_STATE_CACHE_SIZE: int = 10000
+
+    # per-job timeline in job_events; rows are buffered and written in batches
+    TIMELINE_ENABLED: bool = True
+    TIMELINE_FLUSH_INTERVAL: float = 1.0
+    TIMELINE_MAX_PENDING: int = 10000
+
+    # /metrics bypasses user JWTs; scrapers must send METRICS_TOKEN as a bearer
+    # token, and without one it answers 401 unless METRICS_PUBLIC is set
+    METRICS_TOKEN: Optional[str] = None
+    METRICS_PUBLIC: bool = False
+
+    MAX_ACTIVE_JOBS_PER_USER: int = 1
+    ADMISSION_RESERVATION_TTL: float = 600.0
+    # how often NEW jobs never enqueued within the reservation TTL are failed
+    RESERVATION_SWEEP_INTERVAL: float = 30.0
+
+    OUTBOX_INTERVAL: float = 1.0
+    OUTBOX_BATCH_SIZE: int = 10
+    OUTBOX_LEASE: float = 30.0
+    OUTBOX_MAX_ATTEMPTS: int = 10
+
+    PUBSUB_BACKEND: str = "postgres"
+    # session-mode DSN for the LISTEN and reconciler lock connections; defaults
+    # to the DB_* settings
+    PUBSUB_LISTEN_DSN: Optional[str] = None
+
+    WS_MAX_QUEUE: int = 16
+    WS_OVERFLOW_POLICY: str = "drop_oldest"
+    WS_SEND_TIMEOUT: float = 5.0
+    WS_PING_INTERVAL: float = 20.0
+    WS_IDLE_TIMEOUT: float = 60.0
+
+    # polls RunPod for jobs whose webhook never arrived; batched dispatcher
+    # requests (BATCH_SIZE > 1) have no webhook and only complete through it
+    RECONCILER_ENABLED: bool = True
+    RECONCILER_INTERVAL: float = 1.0
+    RECONCILER_MIN_POLL: float = 2.0
+    RECONCILER_MAX_POLL: float = 30.0
+    RECONCILER_CONCURRENCY: int = 10
+    # one API worker polls RunPod; the others retry for the lock this often
+    RECONCILER_ELECTION_INTERVAL: float = 10.0
+
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import os
+import re
+
+from api.db import postgres
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+# files starting with this marker run statement by statement outside a
+# transaction, as required by CREATE INDEX CONCURRENTLY
+NO_TRANSACTION = "-- no-transaction"
+
+def migration_files():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+def split_statements(sql: str):
+    return [statement.strip() for statement in re.split(r";\s*\n", sql) if statement.strip()]
+
+async def migrate():
+    await postgres.init_db()
+    async with postgres.acquire() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name text PRIMARY KEY,
+                applied_on timestamptz NOT NULL DEFAULT now()
+            )
+        """)
+        applied = {row["name"] for row in await conn.fetch("SELECT name FROM schema_migrations")}
+        for name in migration_files():
+            if name in applied:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                sql = f.read()
+            logger.info("applying migration %s", name)
+            if sql.startswith(NO_TRANSACTION):
+                for statement in split_statements(sql):
+                    await conn.execute(statement)
+                await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1)", name)
+            else:
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1)", name)
+    await postgres.pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate())
@@ -0,0 +1,9 @@
+-- no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_userid_created_on_idx
+    ON queue (userid, created_on DESC, s3_object_id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_s3_object_id_idx
+    ON queue (s3_object_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_userid_active_idx
+    ON queue (userid) WHERE status IN ('IN_QUEUE', 'IN_PROGRESS');
@@ -0,0 +1,39 @@
+CREATE TABLE IF NOT EXISTS outbox (
+    id bigserial PRIMARY KEY,
+    s3_object_id text NOT NULL,
+    payload text NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+    available_on timestamptz NOT NULL DEFAULT now(),
+    created_on timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS outbox_available_on_idx ON outbox (available_on);
+
+-- Reserves a queue slot for the user in one round trip. The advisory lock
+-- serialises admissions per user and, because every statement in a volatile
+-- function takes a fresh snapshot, the count sees any admission that
+-- committed while we were waiting for the lock.
+CREATE OR REPLACE FUNCTION admit_job(
+    p_s3_object_id text,
+    p_userid text,
+    p_prompt text,
+    p_image_input text,
+    p_max_active integer,
+    p_reservation_ttl interval
+) RETURNS boolean
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('queue_admission'), hashtext(p_userid));
+
+    IF (SELECT count(*) FROM queue
+        WHERE userid = p_userid
+          AND (status IN ('IN_QUEUE', 'IN_PROGRESS')
+               OR (status = 'NEW' AND created_on > now() - p_reservation_ttl))) >= p_max_active THEN
+        RETURN false;
+    END IF;
+
+    INSERT INTO queue (s3_object_id, userid, status, prompt, image_input)
+    VALUES (p_s3_object_id, p_userid, 'NEW', p_prompt, p_image_input);
+    RETURN true;
+END;
+$$;
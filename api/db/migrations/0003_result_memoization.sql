@@ -0,0 +1,10 @@
+-- no-transaction
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS content_hash text;
+
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS memo_of text;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_content_hash_idx
+    ON queue (content_hash, created_on DESC) WHERE content_hash IS NOT NULL AND memo_of IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_memo_of_idx
+    ON queue (memo_of) WHERE memo_of IS NOT NULL;
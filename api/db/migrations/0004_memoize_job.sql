@@ -0,0 +1,71 @@
+-- Records the content hash of a freshly admitted job and, when lookup is
+-- requested, points it at an earlier job with the same hash: a completed one
+-- hands over its result, an active one is followed until it finishes. The
+-- follower reuses the earlier upload, so nothing is written to S3 for it. The
+-- earlier job's row is locked so it cannot finish between the lookup and the
+-- attach without the trigger below seeing the new follower.
+CREATE OR REPLACE FUNCTION memoize_job(
+    p_s3_object_id text,
+    p_content_hash text,
+    p_lookup boolean,
+    p_reservation_ttl interval
+) RETURNS TABLE (hit_id text, hit_status text, hit_image_result text)
+LANGUAGE plpgsql AS $$
+DECLARE
+    hit record;
+    found_hit boolean := false;
+BEGIN
+    IF p_lookup THEN
+        SELECT q.s3_object_id, q.status, q.image_result, q.image_input INTO hit
+        FROM queue q
+        WHERE q.content_hash = p_content_hash
+          AND q.memo_of IS NULL
+          AND q.s3_object_id <> p_s3_object_id
+          AND (q.status IN ('COMPLETED', 'IN_QUEUE', 'IN_PROGRESS')
+               OR (q.status = 'NEW' AND q.created_on > now() - p_reservation_ttl))
+        ORDER BY q.status = 'COMPLETED' DESC, q.created_on DESC
+        LIMIT 1
+        FOR UPDATE;
+        found_hit := FOUND;
+    END IF;
+
+    IF NOT found_hit THEN
+        UPDATE queue SET content_hash = p_content_hash WHERE queue.s3_object_id = p_s3_object_id;
+        RETURN;
+    END IF;
+
+    UPDATE queue
+    SET content_hash = p_content_hash,
+        memo_of = hit.s3_object_id,
+        status = hit.status,
+        image_result = hit.image_result,
+        image_input = hit.image_input,
+        updated_on = now()
+    WHERE queue.s3_object_id = p_s3_object_id;
+    RETURN QUERY SELECT hit.s3_object_id, hit.status, hit.image_result;
+END;
+$$;
+
+-- Followers take every status change of the job they are attached to,
+-- whichever writer (webhook, reconciler, lambda) made it.
+CREATE OR REPLACE FUNCTION propagate_memoized_status() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE queue
+    SET status = NEW.status,
+        image_result = NEW.image_result,
+        updated_on = now()
+    WHERE memo_of = NEW.s3_object_id
+      AND status NOT IN ('COMPLETED', 'FAILED');
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS queue_propagate_memoized_status ON queue;
+
+CREATE TRIGGER queue_propagate_memoized_status
+    AFTER UPDATE OF status, image_result ON queue
+    FOR EACH ROW
+    WHEN (NEW.memo_of IS NULL AND NEW.content_hash IS NOT NULL
+          AND (OLD.status IS DISTINCT FROM NEW.status OR OLD.image_result IS DISTINCT FROM NEW.image_result))
+    EXECUTE FUNCTION propagate_memoized_status();
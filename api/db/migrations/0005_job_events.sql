@@ -0,0 +1,14 @@
+-- Append-only timeline of the hops a job goes through (API, outbox, SQS,
+-- dispatcher, RunPod, webhook). Each writer batches its rows, and `at` is the
+-- writer's clock, not the insert time. BRIN keeps the time index tiny for
+-- window scans; the btree serves single-job lookups.
+CREATE TABLE IF NOT EXISTS job_events (
+    s3_object_id text NOT NULL,
+    trace_id text,
+    event text NOT NULL,
+    at timestamptz NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS job_events_at_idx ON job_events USING brin (at);
+
+CREATE INDEX IF NOT EXISTS job_events_s3_object_id_idx ON job_events (s3_object_id);
@@ -0,0 +1,6 @@
+-- no-transaction
+-- admit_job counts a user's IN_QUEUE/IN_PROGRESS jobs and recent NEW ones,
+-- which 0001's queue_userid_active_idx does not cover. created_on lets it skip
+-- NEW rows older than the reservation TTL.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_userid_admission_idx
+    ON queue (userid, created_on) WHERE status IN ('NEW', 'IN_QUEUE', 'IN_PROGRESS');
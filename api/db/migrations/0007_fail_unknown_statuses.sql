@@ -0,0 +1,4 @@
+-- the Lambda used to store RunPod's rejection as status 'ERROR', which the API
+-- cannot read; those jobs never ran
+UPDATE queue SET status = 'FAILED', updated_on = now()
+WHERE status NOT IN ('NEW', 'IN_QUEUE', 'IN_PROGRESS', 'COMPLETED', 'FAILED');
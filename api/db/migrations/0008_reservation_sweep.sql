@@ -0,0 +1,7 @@
+-- set in the statement that inserts the job's outbox row; a NEW job without it
+-- past the reservation TTL was never enqueued (the API died mid-request) and
+-- is failed by the outbox relay's sweep
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS enqueued_on timestamptz;
+
+-- jobs admitted before this column existed are already on their way
+UPDATE queue SET enqueued_on = created_on WHERE status = 'NEW' AND enqueued_on IS NULL;
@@ -0,0 +1,15 @@
+-- a COMPLETED callback can arrive without its result URL and a later one fill
+-- it in; followers that already took the COMPLETED pick the URL up as well
+CREATE OR REPLACE FUNCTION propagate_memoized_status() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE queue
+    SET status = NEW.status,
+        image_result = NEW.image_result,
+        updated_on = now()
+    WHERE memo_of = NEW.s3_object_id
+      AND (status NOT IN ('COMPLETED', 'FAILED')
+           OR (status = NEW.status AND image_result IS NULL AND NEW.image_result IS NOT NULL));
+    RETURN NULL;
+END;
+$$;
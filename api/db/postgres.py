@@ -1,12 +1,18 @@
+import json
+from datetime import datetime, timedelta
 from enum import Enum
 import asyncpg
-from typing import Optional, List, Dict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, List, Dict, Tuple
 
 from urllib.parse import quote_plus
 
 from api.config import settings
+from api.metrics import register_gauge, timed
 
 pool: Optional[asyncpg.Pool] = None
+# callers waiting for a free connection in acquire()
+waiting = 0
 
 class TaskStatus(Enum):
     NEW = "NEW"
@@ -15,7 +21,7 @@ class TaskStatus(Enum):
     COMPLETED = "COMPLETED"
     FAILED = "FAILED"
     
-async def init_db():
+def connection_string() -> str:
     user = settings.DB_USER
     password = settings.DB_PASSWORD
     host = settings.DB_HOST
@@ -23,45 +29,249 @@ async def init_db():
     database = settings.DB_SCHEMA
 
     encoded_password = quote_plus(password)
-    conn_str = f"postgresql://{user}:{encoded_password}@{host}:{port}/{database}"
+    return f"postgresql://{user}:{encoded_password}@{host}:{port}/{database}"
+
+async def init_db():
     global pool
     if not pool:
-        pool = await asyncpg.create_pool(conn_str,
+        pool = await asyncpg.create_pool(connection_string(),
+                                         min_size=settings.DB_POOL_MIN_SIZE,
+                                         max_size=settings.DB_POOL_MAX_SIZE,
                                          statement_cache_size=0) #TODO currently using supabase free tier
+        register_gauge("db_pool_size", pool.get_size)
+        register_gauge("db_pool_idle", pool.get_idle_size)
+        register_gauge("db_pool_max", pool.get_max_size)
+        register_gauge("db_pool_waiting", lambda: waiting)
+
+async def connect_session() -> asyncpg.Connection:
+    # a connection outside the pool for session state: LISTEN and advisory
+    # locks do not survive a transaction-mode pooler (Supabase's port 6543),
+    # PUBSUB_LISTEN_DSN points at a session-mode or direct port
+    return await asyncpg.connect(settings.PUBSUB_LISTEN_DSN or connection_string(), statement_cache_size=0)
+
+async def acquire_connection() -> asyncpg.Connection:
+    global waiting
+    waiting += 1
+    try:
+        with timed("db.acquire"):
+            return await pool.acquire()
+    finally:
+        waiting -= 1
+
+async def release_connection(conn: asyncpg.Connection):
+    await pool.release(conn)
+
+@asynccontextmanager
+async def acquire() -> AsyncIterator[asyncpg.Connection]:
+    # every query goes through here so db.acquire covers the wait for a
+    # connection, not just explicit acquires
+    conn = await acquire_connection()
+    try:
+        yield conn
+    finally:
+        await release_connection(conn)
+
+async def _execute(query: str, *args) -> str:
+    async with acquire() as conn:
+        return await conn.execute(query, *args)
+
+async def _fetch(query: str, *args) -> List[asyncpg.Record]:
+    async with acquire() as conn:
+        return await conn.fetch(query, *args)
+
+async def _fetchrow(query: str, *args) -> Optional[asyncpg.Record]:
+    async with acquire() as conn:
+        return await conn.fetchrow(query, *args)
+
+async def _fetchval(query: str, *args):
+    async with acquire() as conn:
+        return await conn.fetchval(query, *args)
+
+async def try_advisory_lock(conn: asyncpg.Connection, name: str) -> bool:
+    # held until released or the session ends
+    return await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", name)
+
+async def notify(channel: str, payload: str):
+    await _execute("SELECT pg_notify($1, $2)", channel, payload)
+
+async def admit_job(s3_object_id: str, userid: str, prompt: str, image_input: str,
+                    max_active: int, reservation_ttl: timedelta) -> bool:
+    return await _fetchval("SELECT admit_job($1, $2, $3, $4, $5, $6)",
+                               s3_object_id, userid, prompt, image_input, max_active, reservation_ttl)
+
+async def enqueue_outbox(s3_object_id: str, payload: str) -> bool:
+    # marks the job enqueued in the same statement, so the reservation sweep and
+    # the enqueue never both win; false when the sweep already failed the job
+    return bool(await _fetchval("""
+        WITH job AS (
+            UPDATE queue SET enqueued_on = now()
+            WHERE s3_object_id = $1 AND status = 'NEW'
+            RETURNING s3_object_id
+        )
+        INSERT INTO outbox (s3_object_id, payload)
+        SELECT s3_object_id, $2 FROM job
+        RETURNING true
+    """, s3_object_id, payload))
+
+async def fail_stale_reservations(reservation_ttl: timedelta) -> List[str]:
+    # admitted jobs that were never enqueued within the reservation TTL, plus
+    # the jobs memoized onto them (the trigger fails those too)
+    rows = await _fetch("""
+        WITH swept AS (
+            UPDATE queue
+            SET status = 'FAILED',
+                updated_on = now()
+            WHERE status = 'NEW' AND enqueued_on IS NULL AND memo_of IS NULL
+              AND created_on < now() - $1::interval
+            RETURNING s3_object_id
+        )
+        SELECT s3_object_id FROM swept
+        UNION ALL
+        SELECT q.s3_object_id FROM queue q JOIN swept s ON q.memo_of = s.s3_object_id
+    """, reservation_ttl)
+    return [row["s3_object_id"] for row in rows]
 
-async def count_user_active_queues(userid: str) -> int:
+async def claim_outbox(limit: int, lease: timedelta) -> List[asyncpg.Record]:
+    # claimed rows stay invisible to other relays for the lease; a failed send
+    # just lets the lease run out, so the lease doubles as the retry backoff
+    return await _fetch("""
+        UPDATE outbox
+        SET available_on = now() + $2::interval * (attempts + 1),
+            attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE available_on <= now()
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, s3_object_id, payload, attempts
+    """, limit, lease)
+
+async def delete_outbox(ids: List[int]):
+    await _execute("DELETE FROM outbox WHERE id = ANY($1::bigint[])", ids)
+
+async def memoize_job(s3_object_id: str, content_hash: str, lookup: bool, reservation_ttl: timedelta) -> Optional[asyncpg.Record]:
+    return await _fetchrow("SELECT * FROM memoize_job($1, $2, $3, $4)",
+                               s3_object_id, content_hash, lookup, reservation_ttl)
+
+async def update_status_result(s3_object_id: str, status: TaskStatus, image_result: Optional[str] = None) -> List[str]:
+    # returns the jobs memoized onto this one; the trigger has already moved them along
+    rows = await _fetch("""
+        WITH updated AS (
+            UPDATE queue
+            SET status = $2,
+                image_result = COALESCE($3, image_result),
+                updated_on = now()
+            WHERE s3_object_id = $1
+            RETURNING s3_object_id
+        )
+        SELECT q.s3_object_id FROM queue q JOIN updated u ON q.memo_of = u.s3_object_id
+    """, s3_object_id, status.value, image_result)
+    return [row["s3_object_id"] for row in rows]
+
+# statuses only move forward; a late or repeated callback never moves a job back.
+# The one update at equal rank: the same status adding a result URL it lacked.
+STATUS_RANK_SQL = """
+    CASE {} WHEN 'NEW' THEN 0 WHEN 'IN_QUEUE' THEN 1 WHEN 'IN_PROGRESS' THEN 2
+            WHEN 'COMPLETED' THEN 3 WHEN 'FAILED' THEN 3 END
+"""
+
+async def update_status_results(updates: List[Tuple[str, TaskStatus, Optional[str]]]) -> List[asyncpg.Record]:
+    # returns (s3_object_id, status) of every row that changed, memoized followers included
+    if not updates:
+        return []
+    ids, statuses, image_results = zip(*((id, status.value, image_result) for id, status, image_result in updates))
+    return await _fetch(f"""
+        WITH updated AS (
+            UPDATE queue AS q
+            SET status = v.status,
+                image_result = COALESCE(v.image_result, q.image_result),
+                updated_on = now()
+            FROM unnest($1::text[], $2::text[], $3::text[]) AS v(s3_object_id, status, image_result)
+            WHERE q.s3_object_id = v.s3_object_id
+              AND ({STATUS_RANK_SQL.format("q.status")} < {STATUS_RANK_SQL.format("v.status")}
+                   OR (q.status = v.status AND q.image_result IS NULL AND v.image_result IS NOT NULL))
+            RETURNING q.s3_object_id, q.status
+        )
+        SELECT s3_object_id, status FROM updated
+        UNION ALL
+        SELECT q.s3_object_id, u.status FROM queue q JOIN updated u ON q.memo_of = u.s3_object_id
+    """, list(ids), list(statuses), list(image_results))
+
+async def get_active_queues() -> List[asyncpg.Record]:
     active_statuses = (TaskStatus.IN_QUEUE.value, TaskStatus.IN_PROGRESS.value)
-    query = """
-        SELECT COUNT(*) FROM queue
-        WHERE userid = $1 AND status = ANY($2::text[])
+    return await _fetch("""
+        SELECT s3_object_id, runpod_id, status,
+               EXTRACT(EPOCH FROM now() - created_on)::float8 AS age_seconds
+        FROM queue
+        WHERE status = ANY($1::text[]) AND runpod_id IS NOT NULL
+    """, active_statuses)
+
+async def get_queues_by_user(userid: str, limit: int, before: Optional[Tuple[datetime, str]] = None) -> List[asyncpg.Record]:
+    columns = """
+        SELECT s3_object_id, status, created_on,
+               to_char(created_on, 'YYYY-MM-DD HH24:MI') AS created_on_text
+        FROM queue
     """
-    row = await pool.fetchrow(query, userid, active_statuses)
-    return row['count'] if row else 0
-
-async def insert_queue(s3_object_id: str, userid: str, prompt: str, image_input: str, status: TaskStatus = TaskStatus.NEW):
-    await pool.execute("""
-        INSERT INTO queue (s3_object_id, userid, status, prompt, image_input)
-        VALUES ($1, $2, $3, $4, $5)
-    """, s3_object_id, userid, status.value, prompt, image_input)
-
-async def update_status_result(s3_object_id: str, status: TaskStatus, image_result: Optional[str] = None):
-    await pool.execute("""
-        UPDATE queue
-        SET status = $2,
-            image_result = COALESCE($3, image_result),
-            updated_on = now()
-        WHERE s3_object_id = $1
-    """, s3_object_id, status.value, image_result)
+    if before is None:
+        return await _fetch(columns + """
+            WHERE userid = $1
+            ORDER BY created_on DESC, s3_object_id DESC
+            LIMIT $2
+        """, userid, limit)
+    return await _fetch(columns + """
+        WHERE userid = $1 AND (created_on, s3_object_id) < ($2, $3)
+        ORDER BY created_on DESC, s3_object_id DESC
+        LIMIT $4
+    """, userid, before[0], before[1], limit)
 
-async def get_queues_by_user(userid: str) -> List[asyncpg.Record]:
-    return await pool.fetch("""
-        SELECT * FROM queue
-        WHERE userid = $1
-        ORDER BY created_on DESC
-    """, userid)
+async def estimate_queues_by_user(userid: str) -> int:
+    # planner row estimate instead of COUNT(*): no scan of the user's rows
+    plan = await _fetchval("EXPLAIN (FORMAT JSON) SELECT 1 FROM queue WHERE userid = $1", userid)
+    return int(json.loads(plan)[0]["Plan"]["Plan Rows"])
 
 async def get_queue_by_id_and_user(s3_object_id: str, userid: str) -> Optional[asyncpg.Record]:
-    return await pool.fetchrow("""
+    return await _fetchrow("""
         SELECT * FROM queue
         WHERE s3_object_id = $1 AND userid = $2
     """, s3_object_id, userid)
+
+async def insert_job_events(events: List[Tuple[str, Optional[str], str, datetime]]):
+    # events are (s3_object_id, trace_id, event, at)
+    await _execute("""
+        INSERT INTO job_events (s3_object_id, trace_id, event, at)
+        SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::timestamptz[])
+    """, *(list(column) for column in zip(*events)))
+
+async def get_job_events(s3_object_id: str) -> List[asyncpg.Record]:
+    return await _fetch("""
+        SELECT event, trace_id, at FROM job_events
+        WHERE s3_object_id = $1
+        ORDER BY at
+    """, s3_object_id)
+
+async def job_stage_percentiles(window: timedelta, spans: List[Tuple[str, str, str]]) -> List[asyncpg.Record]:
+    # spans are (stage, from_event, to_event); a job counts towards a stage when
+    # both of its events fall in the window, repeats of an event keep the first
+    names, starts, ends = (list(column) for column in zip(*spans))
+    return await _fetch("""
+        WITH events AS (
+            SELECT s3_object_id, event, min(at) AS at
+            FROM job_events
+            WHERE at >= now() - $1::interval
+            GROUP BY s3_object_id, event
+        ), spans AS (
+            SELECT * FROM unnest($2::text[], $3::text[], $4::text[]) WITH ORDINALITY AS s(stage, from_event, to_event, ord)
+        )
+        SELECT s.stage, count(*) AS jobs,
+               percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY extract(epoch FROM b.at - a.at)) AS seconds
+        FROM spans s
+        JOIN events a ON a.event = s.from_event
+        JOIN events b ON b.s3_object_id = a.s3_object_id AND b.event = s.to_event
+        GROUP BY s.stage, s.ord
+        ORDER BY s.ord
+    """, window, names, starts, ends)
+
+async def prune_job_events(older_than: timedelta) -> str:
+    return await _execute("DELETE FROM job_events WHERE at < now() - $1::interval", older_than)
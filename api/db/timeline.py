@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import re
+from datetime import timedelta
+
+from api.db import postgres
+from api.services.timeline import STAGES
+
+UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+def parse_window(value: str) -> timedelta:
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if not match:
+        raise argparse.ArgumentTypeError("expected e.g. 30m, 6h or 7d")
+    return timedelta(**{UNITS[match.group(2)]: float(match.group(1))})
+
+def format_seconds(seconds) -> str:
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 10 else f"{seconds:.1f}s"
+
+async def report(window: timedelta):
+    rows = await postgres.job_stage_percentiles(window, STAGES)
+    print(f"{'stage':<18} {'jobs':>7} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for row in rows:
+        p50, p95, p99 = row["seconds"]
+        print(f"{row['stage']:<18} {row['jobs']:>7} {format_seconds(p50):>9} {format_seconds(p95):>9} "
+              f"{format_seconds(p99):>9}")
+
+async def show_job(s3_object_id: str):
+    events = await postgres.get_job_events(s3_object_id)
+    if not events:
+        print(f"no events for {s3_object_id}")
+        return
+    first = events[0]["at"]
+    for row in events:
+        offset = (row["at"] - first).total_seconds()
+        print(f"{row['at'].isoformat()}  +{format_seconds(offset):>8}  {row['event']:<18} {row['trace_id'] or ''}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Per-stage job latency from the job_events timeline")
+    parser.add_argument("--window", type=parse_window, default=timedelta(hours=1),
+                        help="how far back to look, e.g. 30m, 6h, 7d (default 1h)")
+    parser.add_argument("--job", help="print the timeline of one job instead")
+    parser.add_argument("--prune", type=parse_window, help="delete events older than this first")
+    args = parser.parse_args()
+
+    await postgres.init_db()
+    try:
+        if args.prune:
+            print(await postgres.prune_job_events(args.prune))
+        if args.job:
+            await show_job(args.job)
+        else:
+            await report(args.window)
+    finally:
+        await postgres.pool.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,88 +1,139 @@
-import asyncio
 import json
 import logging
-from typing import Dict, List
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Request, Response, UploadFile, File, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
-from api.integration.runpod import RunpodException
-from api.middleware.jwt import decode_jwt_token
+import re
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from api.config import settings
+from api.services.connections import PONG, manager
+from api.services.imaging import parse_resolution
+from api.services.intake import UploadRejected, read_image_form
 from api.integration.webhook import verify_signature
 from api.models.schema import GenerationResponse, JobStatusResponse, QueueItemResponse
-from api.services.queue import ExceededLimit, get_latest_status, get_pending_queue, new_queue, queues_by_user, update_status
+from api.services.queue import ExceededLimit, get_image, get_image_url, get_latest_status, get_pending_queue, new_queue, queues_by_user
+from api.services.ingest import ingestor, parse_status
+from api.services.timeline import record_webhook
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
 MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 MB
-ALLOWED_IMAGE_TYPES = ["image/jpeg","image/jpg","image/png"]
-
-@router.post("/generate", response_model=GenerationResponse)
-async def generate(
-    request: Request,
-    image: UploadFile = File(...),
-    prompt: str = Form(...)
-):
-    contents = await image.read()
-
-    if len(contents) > MAX_IMAGE_SIZE:
-        raise HTTPException(
-            status_code=413,
-            detail="Image size must be less than 5MB"
-        )
-
-    if image.content_type not in ALLOWED_IMAGE_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid image type. Allowed types: {', '.join(ALLOWED_IMAGE_TYPES)}"
-        )
-    image.file.seek(0)
+RANGE_PATTERN = re.compile(r"bytes=\d*-\d*")
+
+GENERATE_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["image", "prompt"],
+            "properties": {
+                "image": {"type": "string", "format": "binary"},
+                "prompt": {"type": "string"},
+                "resolution": {"type": "string", "example": "512x512"},
+                "no_cache": {"type": "boolean", "description": "always run a fresh generation"},
+            },
+        }}},
+    }
+}
+
+@router.post("/generate", response_model=GenerationResponse, openapi_extra=GENERATE_FORM_SCHEMA)
+async def generate(request: Request):
+    try:
+        form = await read_image_form(request, MAX_IMAGE_SIZE)
+    except UploadRejected as ur:
+        raise HTTPException(status_code=ur.status_code, detail=ur.detail)
 
     try:
-        key = await new_queue(request.state.user_id,image,prompt)
+        image = form["image"]
+        prompt = form.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise HTTPException(status_code=422, detail="Missing prompt")
+        resolution = form.get("resolution") or None
+        if resolution is not None:
+            try:
+                parse_resolution(resolution)
+            except (TypeError, ValueError, AttributeError):
+                raise HTTPException(status_code=422, detail="Invalid resolution, expected WIDTHxHEIGHT")
+
+        no_cache = str(form.get("no_cache", "")).lower() in ("1", "true", "yes", "on")
+
+        key = await new_queue(request.state.user_id,image,prompt,resolution,memoize=not no_cache,
+                              tier=getattr(request.state, "user_tier", None))
         return GenerationResponse(job_id=key)
+    except HTTPException:
+        raise
     except ExceededLimit as el:
         raise HTTPException(status_code=400, detail="Another request is still in the queue or in progress")
     except Exception as e :
         logger.error("Error Generate: %s", str(e))
         raise HTTPException(status_code=500, detail=f"Internal error")
+    finally:
+        await form.close()
 
 @router.get("/status/{job_id}", response_model=JobStatusResponse)
 async def get_status(
     request: Request,
     job_id: str):
     try:
-        status, file_stream = await get_latest_status(job_id,request.state.user_id)
+        status, image_result = await get_latest_status(job_id,request.state.user_id)
         headers = {
             "X-Image-Metadata": json.dumps({"status": status}),
             "Cache-Control": "no-store"
         }
-        if file_stream is not None:
-            headers["Cache-Control"] = "public, max-age=86400"
-            return StreamingResponse(file_stream, media_type="image/png", headers=headers)
-        return Response(status_code=200, headers=headers)                 
-    except RunpodException as re:
-        raise HTTPException(status_code=re.code,detail=re.message)
+        if image_result is None:
+            return Response(status_code=200, headers=headers)
+
+        if settings.STATUS_IMAGE_DELIVERY == "redirect":
+            url, max_age = get_image_url(image_result)
+            headers["Cache-Control"] = f"private, max-age={max_age}"
+            return RedirectResponse(url, status_code=302, headers=headers)
+
+        byte_range = request.headers.get("range")
+        if byte_range and not RANGE_PATTERN.fullmatch(byte_range):
+            byte_range = None
+        image = await get_image(image_result, request.headers.get("if-none-match"), byte_range)
+        headers["Cache-Control"] = "public, max-age=86400"
+        headers["Accept-Ranges"] = "bytes"
+        if image.etag:
+            headers["ETag"] = image.etag
+        if image.status_code in (304, 416):
+            return Response(status_code=image.status_code, headers=headers)
+        if image.content_length is not None:
+            headers["Content-Length"] = str(image.content_length)
+        if image.content_range:
+            headers["Content-Range"] = image.content_range
+        return StreamingResponse(image.body, status_code=image.status_code,
+                                 media_type=image.content_type or "image/png", headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal error")
     
 @router.get("/queues", response_model=List[QueueItemResponse])
-async def get_queues(request: Request):
-    rows = await queues_by_user(request.state.user_id )
-    formatted_rows = []
-    for row in rows:
-        formatted_row = QueueItemResponse(
-            s3_object_id=row['s3_object_id'],
-            status=row['status'],
-            created_on=row['created_on'].strftime('%Y-%m-%d %H:%M')  # Format timestamp
-        )
-        formatted_rows.append(formatted_row)
-    
-    return formatted_rows
+async def get_queues(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None),
+    count: bool = Query(False)):
+    try:
+        rows, next_cursor, total = await queues_by_user(request.state.user_id, limit, before, count)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    headers = {}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+    # rows already carry the three response fields, skip per-row model validation
+    items = [
+        {"s3_object_id": row["s3_object_id"], "status": row["status"], "created_on": row["created_on_text"]}
+        for row in rows
+    ]
+    return JSONResponse(items, headers=headers)
     
 
 @router.post("/webhook/{id}")
-async def webhook(id: str, request: Request, background_tasks: BackgroundTasks):
+async def webhook(id: str, request: Request):
     sig = request.query_params.get("sig")
     if not sig:
         raise HTTPException(status_code=400, detail="Missing signature")
@@ -90,32 +141,26 @@ async def webhook(id: str, request: Request, background_tasks: BackgroundTasks):
     if not verify_signature(id, sig):
         raise HTTPException(status_code=403, detail="Invalid signature")
 
-    data = await request.json()
-    status = data.get("status")
-    result_url = data.get("output", {}).get("message")
-    await update_status(id,status,result_url)
-    background_tasks.add_task(send_message_to_user, id, status)
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Expected a JSON object")
+    status = parse_status(data.get("status"))
+    if status is None:
+        raise HTTPException(status_code=400, detail="Unknown status")
+    output = data.get("output")
+    result_url = output.get("message") if isinstance(output, dict) else None
+    ingestor.submit(id, status, result_url if isinstance(result_url, str) else None)
+    record_webhook(id, request.query_params.get("trace"), status, data)
 
     return Response(status_code=200)
 
-user_connections: Dict[str, List[WebSocket]] = {}
-user_connections_lock = asyncio.Lock()
-
-
-async def send_message_to_user(id: str, message: str):
-    connections = user_connections.get(id, [])
-    
-    for connection in connections:
-        try:
-            await connection.send_text(message)
-        except Exception as e:
-            logger.error(f"Error sending message for id {id}: {e}")
-
 @router.websocket("/ws/status")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(...),id: str = Query(...)):
+async def websocket_endpoint(websocket: WebSocket, id: str = Query(...)):
     try:
-        payload = decode_jwt_token(token)
-        userid = payload.get("sub")
+        userid = websocket.state.user_id
         queue = await get_pending_queue(id,userid)
         if not queue:
             await websocket.close(code=1008)
@@ -127,24 +172,18 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(...),id: s
         return
     
     await websocket.accept()
-    async with user_connections_lock:
-        if id not in user_connections:
-            user_connections[id] = []
-
-        user_connections[id].append(websocket)
+    conn = await manager.connect(id, websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(data)
+            manager.touch(conn)
+            if data == PONG:
+                continue
+            manager.send(conn, data)
             if data == "COMPLETED":
+                await manager.flush(conn)
                 break
-        
-        await websocket.close()
     except WebSocketDisconnect:
-        async with user_connections_lock:
-            if id in user_connections:
-                user_connections[id].remove(websocket)
-                
-                if not user_connections[id]:
-                    del user_connections[id]
-        logger.debug("Client disconnected")
\ No newline at end of file
+        logger.debug("Client disconnected")
+    finally:
+        await manager.disconnect(conn)
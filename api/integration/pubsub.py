@@ -0,0 +1,160 @@
+import abc
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import asyncpg
+
+from api.db import postgres
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+class PubSubBackend(abc.ABC):
+    @abc.abstractmethod
+    async def start(self, handler: Handler):
+        ...
+
+    @abc.abstractmethod
+    async def close(self):
+        ...
+
+    @abc.abstractmethod
+    async def publish(self, job_id: str, message: str):
+        ...
+
+    @abc.abstractmethod
+    async def subscribe(self, job_id: str):
+        ...
+
+    @abc.abstractmethod
+    async def unsubscribe(self, job_id: str):
+        ...
+
+class InMemoryPubSub(PubSubBackend):
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+        self.channels: Set[str] = set()
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def close(self):
+        self.channels.clear()
+
+    async def publish(self, job_id: str, message: str):
+        if job_id in self.channels:
+            await self.handler(job_id, message)
+
+    async def subscribe(self, job_id: str):
+        self.channels.add(job_id)
+
+    async def unsubscribe(self, job_id: str):
+        self.channels.discard(job_id)
+
+class PostgresPubSub(PubSubBackend):
+    CHANNEL_PREFIX = "job_"
+
+    def __init__(self, reconnect_delay: float = 1.0):
+        self.reconnect_delay = reconnect_delay
+        self.handler: Optional[Handler] = None
+        self.conn: Optional[asyncpg.Connection] = None
+        self.channels: Dict[str, str] = {}
+        # asyncpg connections do not allow concurrent operations
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def channel(self, job_id: str) -> str:
+        return f"{self.CHANNEL_PREFIX}{job_id}"
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        async with self._lock:
+            await self._connect()
+
+    async def _connect(self):
+        # a connection of its own rather than one of the pool's: it is held
+        # for the life of the process, and LISTEN needs a session
+        self.conn = await postgres.connect_session()
+        self.conn.add_termination_listener(self._on_terminated)
+        for channel in self.channels.values():
+            await self.conn.add_listener(channel, self._on_notification)
+
+    def _on_terminated(self, conn):
+        if not self._closed:
+            logger.error("pubsub listener connection lost, reconnecting")
+            asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        async with self._lock:
+            while not self._closed:
+                try:
+                    old, self.conn = self.conn, None
+                    if old:
+                        old.terminate()
+                    await self._connect()
+                    return
+                except Exception as e:
+                    logger.error("pubsub reconnect failed: %s", e)
+                    await asyncio.sleep(self.reconnect_delay)
+
+    def _on_notification(self, conn, pid, channel, payload):
+        job_id = channel[len(self.CHANNEL_PREFIX):]
+        asyncio.get_running_loop().create_task(self._deliver(job_id, payload))
+
+    async def _deliver(self, job_id: str, message: str):
+        try:
+            await self.handler(job_id, message)
+        except Exception as e:
+            logger.error("pubsub delivery for %s failed: %s", job_id, e)
+
+    async def close(self):
+        self._closed = True
+        async with self._lock:
+            if self.conn:
+                for channel in self.channels.values():
+                    await self.conn.remove_listener(channel, self._on_notification)
+                await self.conn.close()
+                self.conn = None
+
+    async def publish(self, job_id: str, message: str):
+        await postgres.notify(self.channel(job_id), message)
+
+    async def subscribe(self, job_id: str):
+        async with self._lock:
+            if job_id in self.channels:
+                return
+            channel = self.channels[job_id] = self.channel(job_id)
+            if self.conn:
+                await self.conn.add_listener(channel, self._on_notification)
+
+    async def unsubscribe(self, job_id: str):
+        async with self._lock:
+            channel = self.channels.pop(job_id, None)
+            if channel and self.conn:
+                await self.conn.remove_listener(channel, self._on_notification)
+
+backend: Optional[PubSubBackend] = None
+
+async def init_pubsub(handler: Handler, name: str = "postgres"):
+    global backend
+    if backend:
+        return
+    backend = InMemoryPubSub() if name == "memory" else PostgresPubSub()
+    await backend.start(handler)
+
+async def close_pubsub():
+    global backend
+    if backend:
+        await backend.close()
+        backend = None
+
+async def publish(job_id: str, message: str):
+    await backend.publish(job_id, message)
+
+async def subscribe(job_id: str):
+    await backend.subscribe(job_id)
+
+async def unsubscribe(job_id: str):
+    await backend.unsubscribe(job_id)
@@ -1,6 +1,12 @@
 import aiohttp
 import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
 from api.config import settings
+from api.metrics import timed
+
+logger = logging.getLogger(__name__)
 
 class RunpodException(Exception):
     def __init__(self, code: int, message: str):
@@ -8,20 +14,122 @@ class RunpodException(Exception):
         self.message = message
         super().__init__(message)
 
+class RunpodClient:
+    def __init__(self, base_url: str, secret: str, cache_ttl: float = 1.0,
+                 connect_timeout: float = 3.0, read_timeout: float = 10.0, max_connections: int = 100):
+        self.base_url = base_url.rstrip("/")
+        self.secret = secret
+        self.cache_ttl = cache_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._cache: Dict[str, Tuple[float, Tuple[str, Optional[str], Optional[float]]]] = {}
+
+    async def start(self):
+        if self.session:
+            return
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.read_timeout),
+            headers={"Authorization": self.secret},
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def status(self, id: str):
+        cached = self._cache.get(id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        # single-flight: concurrent pollers of the same job share one upstream call
+        future = self._inflight.get(id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_status(id))
+            self._inflight[id] = future
+            future.add_done_callback(lambda f: self._finish(id, f))
+        return await asyncio.shield(future)
+
+    def _finish(self, id: str, future: asyncio.Future):
+        self._inflight.pop(id, None)
+        if not future.cancelled() and future.exception() is None and self.cache_ttl > 0:
+            self._cache[id] = (time.monotonic() + self.cache_ttl, future.result())
+        self._evict_expired()
+
+    def _evict_expired(self):
+        if len(self._cache) < 1024:
+            return
+        now = time.monotonic()
+        for key in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[key]
+
+    async def _fetch_status(self, id: str):
+        url = f"{self.base_url}/status/{id}"
+        with timed("runpod.status"):
+            async with self.session.get(url) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    status = data.get("status")
+                    message = (data.get("output") or {}).get("message") if status == "COMPLETED" else None
+                    # GPU milliseconds, present once the job has finished
+                    execution_ms = data.get("executionTime")
+                    return status, message, execution_ms if isinstance(execution_ms, (int, float)) else None
+                elif response.status == 404:
+                    raise RunpodException(404, "record not found or has already expired")
+                else:
+                    raise ValueError(f"runpod status failed with status code {response.status}")
+
+client: Optional[RunpodClient] = None
+
+async def init_runpod():
+    global client
+    if not client:
+        client = RunpodClient(
+            settings.RUNPOD_URL,
+            settings.RUNPOD_SECRET,
+            cache_ttl=settings.RUNPOD_STATUS_CACHE_TTL,
+            connect_timeout=settings.RUNPOD_CONNECT_TIMEOUT,
+            read_timeout=settings.RUNPOD_READ_TIMEOUT,
+            max_connections=settings.RUNPOD_MAX_CONNECTIONS,
+        )
+        await client.start()
+
+async def close_runpod():
+    global client
+    if client:
+        await client.close()
+        client = None
+
 async def runpod_status(id: str):
-    headers = {
-        "Authorization": settings.RUNPOD_SECRET
-    }
-    url = f"{settings.RUNPOD_URL}/status/{id}"
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json() 
-                status = data.get("status")
-                message = data.get("output", {}).get("message") if status == "COMPLETED" else None
-                return status, message
-            elif response.status == 404:
-                raise RunpodException(404, "record not found or has already expired")
-            else:
-                raise ValueError(f"runpod status failed with status code {response.status}")
+    return await client.status(id)
+
+def batch_result(message, s3_object_id: str):
+    # a batched request saves each job's image under its s3_object_id prefix.
+    # The worker must return every saved image URL as a list in output.message
+    # (the dispatcher's BATCH_WORKER_OUTPUT=list); the stock worker's single
+    # message cannot be split per job
+    if not isinstance(message, list):
+        logger.error("batched request returned %r instead of a list of image URLs", message)
+        return None
+    for url in message:
+        if isinstance(url, str) and url.rsplit("/", 1)[-1].startswith(s3_object_id):
+            return url
+    return None
+
+async def runpod_job_status(runpod_id: str, s3_object_id: str):
+    # "<request id>#<n>" marks one job of a batched request; the request is
+    # polled once (single-flight) and its output split per job
+    if "#" not in runpod_id:
+        return await runpod_status(runpod_id)
+    status, message, execution_ms = await runpod_status(runpod_id.split("#", 1)[0])
+    if status != "COMPLETED":
+        return status, None, execution_ms
+    result = batch_result(message, s3_object_id)
+    if result is None:
+        logger.error("batch %s has no output for %s", runpod_id, s3_object_id)
+        return "FAILED", None, execution_ms
+    return status, result, execution_ms
@@ -1,47 +1,142 @@
 import asyncio
-import base64
-import boto3
+import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
 from api.config import settings
+from api.metrics import register_gauge, timed
+
+logger = logging.getLogger(__name__)
 
-class S3Exception:
+class S3Exception(Exception):
     pass
 
-def __init_s3_client():
-    region = settings.S3_REGION
-    return boto3.client('s3', region_name=region)
+client = None
+executor: Optional[ThreadPoolExecutor] = None
+transfer_config: Optional[TransferConfig] = None
+executor_calls = 0
 
-def get_image_froms3_sync(object_key):
-    bucket = settings.S3_BUCKET_NAME
-    s3 = __init_s3_client()
+def init_s3():
+    global client, executor, transfer_config
+    if client:
+        return
+    # one client for the whole process: credential lookup, endpoint resolution and
+    # the urllib3 connection pool are paid once instead of per request
+    client = boto3.session.Session().client(
+        's3',
+        region_name=settings.S3_REGION,
+        config=Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS),
+    )
+    executor = ThreadPoolExecutor(max_workers=settings.S3_EXECUTOR_WORKERS, thread_name_prefix="s3")
+    # calls waiting for a free worker thread, not the ones running
+    register_gauge("s3_executor_queue_depth", lambda: max(0, executor_calls - settings.S3_EXECUTOR_WORKERS))
+    transfer_config = TransferConfig(
+        multipart_threshold=settings.S3_MULTIPART_CHUNK_SIZE,
+        multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE,
+        max_concurrency=settings.S3_MULTIPART_CONCURRENCY,
+    )
+
+def close_s3():
+    global client, executor
+    if executor:
+        executor.shutdown(wait=False)
+        executor = None
+    if client:
+        client.close()
+        client = None
+
+async def _run(fn, *args):
+    global executor_calls
+    loop = asyncio.get_running_loop()
+    executor_calls += 1
     try:
-        response = s3.get_object(Bucket=bucket, Key=object_key)
-        return response['Body']
-    except Exception as e:
-        raise e
-    
-async def get_image_froms3(object_key):
+        return await loop.run_in_executor(executor, fn, *args)
+    finally:
+        executor_calls -= 1
+
+class S3Object:
+    def __init__(self, status_code: int, body: Optional[AsyncIterator[bytes]], etag: Optional[str] = None,
+                 content_type: Optional[str] = None, content_length: Optional[int] = None,
+                 content_range: Optional[str] = None):
+        self.status_code = status_code
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        self.content_length = content_length
+        self.content_range = content_range
+
+def get_image_froms3_sync(object_key, if_none_match=None, byte_range=None):
+    params = {"Bucket": settings.S3_BUCKET_NAME, "Key": object_key}
+    if if_none_match:
+        params["IfNoneMatch"] = if_none_match
+    if byte_range:
+        params["Range"] = byte_range
     try:
-        return await asyncio.to_thread(get_image_froms3_sync,object_key)
-    except Exception as e:
-        raise S3Exception("failed to get image") from e
-    
-def upload_to_s3_sync(image):
-    key = str(uuid.uuid4())
-    bucket = settings.S3_BUCKET_NAME
-    region = settings.S3_REGION
+        return client.get_object(**params)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return None
+        raise
 
-    s3_client = __init_s3_client()
-    file_url = f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
+async def iter_body(body, chunk_size: int) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            with timed("s3.read_chunk"):
+                chunk = await _run(body.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
 
+async def get_image_froms3(object_key, if_none_match=None, byte_range=None) -> S3Object:
     try:
-        s3_client.upload_fileobj(image.file, settings.S3_BUCKET_NAME, key)
+        with timed("s3.get_object"):
+            response = await _run(get_image_froms3_sync, object_key, if_none_match, byte_range)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return S3Object(416, None)
+        raise S3Exception("failed to get image") from e
     except Exception as e:
-        raise e
-    return [key,file_url]
+        raise S3Exception("failed to get image") from e
+    if response is None:
+        return S3Object(304, None, etag=if_none_match)
+    return S3Object(
+        206 if response.get("ContentRange") else 200,
+        iter_body(response["Body"], settings.S3_STREAM_CHUNK_SIZE),
+        etag=response.get("ETag"),
+        content_type=response.get("ContentType"),
+        content_length=response.get("ContentLength"),
+        content_range=response.get("ContentRange"),
+    )
+
+def presigned_get_url(object_key: str, expires_in: int) -> str:
+    # signing is local, no request is made
+    return client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": settings.S3_BUCKET_NAME, "Key": object_key},
+        ExpiresIn=expires_in,
+    )
+
+def object_url(key: str) -> str:
+    return f"https://{settings.S3_BUCKET_NAME}.s3.{settings.S3_REGION}.amazonaws.com/{key}"
+
+def upload_to_s3_sync(image, key):
+    # upload_fileobj switches to multipart above the threshold and reads the
+    # spooled upload part by part, so the file is never fully loaded here
+    extra_args = {"ContentType": image.content_type} if image.content_type else None
+    client.upload_fileobj(image.file, settings.S3_BUCKET_NAME, key, ExtraArgs=extra_args, Config=transfer_config)
+    return [key,object_url(key)]
 
-async def upload_to_s3(image):
+async def upload_to_s3(image, key=None):
     try:
-        return await asyncio.to_thread(upload_to_s3_sync, image)
+        with timed("s3.upload"):
+            return await _run(upload_to_s3_sync, image, key or str(uuid.uuid4()))
     except Exception as e:
-        raise S3Exception("failed to upload") from e
\ No newline at end of file
+        raise S3Exception("failed to upload") from e
@@ -1,12 +1,151 @@
 import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
 import boto3
 from api.config import settings
+from api.metrics import incr, register_gauge, timed
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_MESSAGES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+class SqsBatchError(Exception):
+    def __init__(self, code: str, message: str):
+        self.code = code
+        self.message = message
+        super().__init__(f"{code}: {message}")
+
+class _Entry:
+    __slots__ = ("body", "size", "future", "attempts")
+
+    def __init__(self, body: str, future: asyncio.Future):
+        self.body = body
+        self.size = len(body.encode())
+        self.future = future
+        self.attempts = 0
+
+class SqsPublisher:
+    def __init__(self, client, queue_url: str, max_wait: float = 0.005, max_batch: int = MAX_BATCH_MESSAGES,
+                 max_bytes: int = MAX_BATCH_BYTES, max_attempts: int = 3, workers: int = 4):
+        self.client = client
+        self.queue_url = queue_url
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqs")
+        self._executor_calls = 0
+        self._pending: List[_Entry] = []
+        self._pending_bytes = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def executor_queue_depth(self) -> int:
+        # batches waiting for a free worker thread, not the ones being sent
+        return max(0, self._executor_calls - self.workers)
+
+    async def send(self, body: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self._add(_Entry(body, future))
+        return await future
+
+    def _add(self, entry: _Entry):
+        if self._pending and self._pending_bytes + entry.size > self.max_bytes:
+            self._flush()
+        self._pending.append(entry)
+        self._pending_bytes += entry.size
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        task = asyncio.get_running_loop().create_task(self._send_batch(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send_batch(self, batch: List[_Entry]):
+        entries = [{"Id": str(i), "MessageBody": entry.body} for i, entry in enumerate(batch)]
+        incr("sqs.batches")
+        incr("sqs.batch_messages", len(batch))
+        loop = asyncio.get_running_loop()
+        try:
+            with timed("sqs.flush"):
+                self._executor_calls += 1
+                try:
+                    response = await loop.run_in_executor(
+                        self.executor,
+                        lambda: self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries),
+                    )
+                finally:
+                    self._executor_calls -= 1
+        except Exception as e:
+            logger.error("sqs send_message_batch failed: %s", e)
+            for entry in batch:
+                self._retry_or_fail(entry, e)
+            return
+
+        for ok in response.get("Successful", []):
+            entry = batch[int(ok["Id"])]
+            if not entry.future.done():
+                entry.future.set_result(ok.get("MessageId"))
+        for failed in response.get("Failed", []):
+            entry = batch[int(failed["Id"])]
+            error = SqsBatchError(failed.get("Code", ""), failed.get("Message", ""))
+            if failed.get("SenderFault"):
+                # malformed message, retrying cannot help
+                self._fail(entry, error)
+            else:
+                self._retry_or_fail(entry, error)
+
+    def _retry_or_fail(self, entry: _Entry, error: Exception):
+        entry.attempts += 1
+        if entry.attempts < self.max_attempts and not entry.future.done():
+            incr("sqs.retries")
+            self._add(entry)
+        else:
+            self._fail(entry, error)
+
+    def _fail(self, entry: _Entry, error: Exception):
+        incr("sqs.failures")
+        if not entry.future.done():
+            entry.future.set_exception(error)
+
+    async def close(self):
+        self._flush()
+        while self._flushes:
+            await asyncio.gather(*list(self._flushes), return_exceptions=True)
+            self._flush()
+        self.executor.shutdown(wait=False)
+
+publisher: Optional[SqsPublisher] = None
+
+def init_sqs():
+    global publisher
+    if not publisher:
+        client = boto3.session.Session().client('sqs', region_name=settings.SQS_REGION)
+        publisher = SqsPublisher(client, settings.SQS_URL, max_wait=settings.SQS_BATCH_WAIT)
+        register_gauge("sqs_pending_messages", publisher.pending_count)
+        register_gauge("sqs_executor_queue_depth", publisher.executor_queue_depth)
 
-queue_url = settings.SQS_URL
+async def close_sqs():
+    global publisher
+    if publisher:
+        await publisher.close()
+        publisher = None
 
 async def send_message(message):
-    try:
-        sqs = boto3.client('sqs', region_name=settings.SQS_REGION)
-        await asyncio.to_thread(sqs.send_message, QueueUrl=queue_url, MessageBody=message)
-    except Exception as e:
-        raise
\ No newline at end of file
+    return await publisher.send(message)
@@ -1,6 +1,7 @@
 import hashlib
 import hmac
 import posixpath
+from typing import Optional
 from urllib.parse import urlencode, urljoin, urlparse, urlunparse
 from api.config import settings
 
@@ -13,8 +14,11 @@ def verify_signature(id: str, signature: str) -> bool:
 def generate_sig(id: str) -> str:
     return hmac.new(settings.SIGNATURE_SECRET.encode(), id.encode(), hashlib.sha256).hexdigest()
 
-def generate_webhook_url(id: str)->str:
+def generate_webhook_url(id: str, trace_id: Optional[str] = None)->str:
     sig = {"sig": generate_sig(id)}
+    if trace_id:
+        # not signed; it only labels the job's timeline events
+        sig["trace"] = trace_id
     
     base_url = settings.APP_BASE_URL
     if not base_url.endswith("/"):
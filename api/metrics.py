@@ -0,0 +1,155 @@
+import re
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+# seconds; the last bucket is +Inf and equals count
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class LatencyCounter:
+    # a histogram; observe() is a handful of integer and float updates so it
+    # can stay on the hot path
+    __slots__ = ("name", "labels", "count", "errors", "total", "max", "buckets")
+
+    def __init__(self, name: str, labels: Labels = ()):
+        self.name = name
+        self.labels = labels
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+        index = bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            self.buckets[index] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_seconds": self.total,
+            "avg_seconds": self.total / self.count if self.count else 0.0,
+            "max_seconds": self.max,
+        }
+
+
+latencies: Dict[Tuple[str, Labels], LatencyCounter] = {}
+
+
+def latency(name: str, labels: Labels = ()) -> LatencyCounter:
+    key = (name, labels)
+    counter = latencies.get(key)
+    if counter is None:
+        counter = latencies[key] = LatencyCounter(name, labels)
+    return counter
+
+
+counters: Dict[str, int] = {}
+
+
+def incr(name: str, value: int = 1):
+    counters[name] = counters.get(name, 0) + value
+
+
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def register_gauge(name: str, fn: Callable[[], float]):
+    gauges[name] = fn
+
+
+class _Timer:
+    # a plain class rather than @contextmanager: no generator per call
+    __slots__ = ("counter", "start")
+
+    def __init__(self, counter: LatencyCounter):
+        self.counter = counter
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.counter.observe(time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+
+def timed(name: str) -> _Timer:
+    return _Timer(latency(name))
+
+
+HTTP_FAMILY = "http"
+PREFIX = "headless_comfy_"
+
+
+def metric_name(name: str) -> str:
+    return PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def render_histogram(lines: List[str], family: str, counter: LatencyCounter, labels: Labels):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, counter.buckets):
+        cumulative += count
+        lines.append(f"{family}_bucket{format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+    lines.append(f"{family}_bucket{format_labels(labels + (('le', '+Inf'),))} {counter.count}")
+    lines.append(f"{family}_sum{format_labels(labels)} {counter.total}")
+    lines.append(f"{family}_count{format_labels(labels)} {counter.count}")
+
+
+def render_prometheus() -> str:
+    # Prometheus text exposition format 0.0.4
+    lines: List[str] = []
+    http_family = metric_name("http_request_duration_seconds")
+    stage_family = metric_name("stage_duration_seconds")
+    errors_family = metric_name("stage_errors_total")
+    http = [c for (name, _), c in list(latencies.items()) if name == HTTP_FAMILY]
+    stages = [c for (name, _), c in list(latencies.items()) if name != HTTP_FAMILY]
+
+    lines.append(f"# HELP {http_family} HTTP request latency by route")
+    lines.append(f"# TYPE {http_family} histogram")
+    for counter in http:
+        render_histogram(lines, http_family, counter, counter.labels)
+
+    lines.append(f"# HELP {stage_family} Latency of internal stages (DB, S3, SQS, RunPod, ...)")
+    lines.append(f"# TYPE {stage_family} histogram")
+    for counter in stages:
+        render_histogram(lines, stage_family, counter, (("stage", counter.name),) + counter.labels)
+    lines.append(f"# TYPE {errors_family} counter")
+    for counter in stages:
+        lines.append(f"{errors_family}{format_labels((('stage', counter.name),) + counter.labels)} {counter.errors}")
+
+    for name, value in list(counters.items()):
+        family = metric_name(name) + "_total"
+        lines.append(f"# TYPE {family} counter")
+        lines.append(f"{family} {value}")
+
+    for name, fn in list(gauges.items()):
+        try:
+            value = float(fn())
+        except Exception:
+            continue
+        family = metric_name(name)
+        lines.append(f"# TYPE {family} gauge")
+        lines.append(f"{family} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,37 +1,103 @@
+import hashlib
 import logging
-from fastapi import Request, HTTPException
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qs
+
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+from starlette.websockets import WebSocketClose
 
 from jose import jwt
 from api.config import settings
 
 logger = logging.getLogger(__name__)
 
-class JWTAuthMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-
-    async def dispatch(self, request: Request, call_next):
-        if (request.method == "OPTIONS"
-            or request.url.path.startswith("/auth/")
-            or request.url.path.startswith("/webhook/")
-        ):
-            return await call_next(request)
-        auth_header = request.headers.get("Authorization")
+PUBLIC_PREFIXES = ("/auth/", "/webhook/")
+PUBLIC_PATHS = ("/metrics",)
+
+class TokenCache:
+    def __init__(self, max_size: int = 4096, max_ttl: float = 300.0):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = hashlib.sha256(token.encode()).digest()
+        entry = self._entries.get(key)
+        if entry is not None:
+            payload, expires = entry
+            if expires > time.time():
+                self._entries.move_to_end(key)
+                return payload
+            del self._entries[key]
+
+        payload = decode_jwt_token(token)
+        expires = time.time() + self.max_ttl
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            expires = min(expires, exp)
+        self._entries[key] = (payload, expires)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return payload
+
+class JWTAuthMiddleware:
+    def __init__(self, app: ASGIApp, cache_size: int = settings.JWT_CACHE_SIZE, cache_ttl: float = settings.JWT_CACHE_MAX_TTL):
+        self.app = app
+        self.cache = TokenCache(cache_size, cache_ttl)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.websocket(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def http(self, scope: Scope, receive: Receive, send: Send):
+        if (scope["method"] == "OPTIONS" or scope["path"].startswith(PUBLIC_PREFIXES)
+                or scope["path"] in PUBLIC_PATHS):
+            return await self.app(scope, receive, send)
+
+        auth_header = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                auth_header = value.decode("latin-1")
+                break
         if not auth_header or not auth_header.startswith("Bearer "):
-            return JSONResponse(status_code=401, content={"detail": "Invalid or missing Authorization header"})
+            response = JSONResponse(status_code=401, content={"detail": "Invalid or missing Authorization header"})
+            return await response(scope, receive, send)
 
         token = auth_header[7:]  # Remove "Bearer "
         try:
-            payload = decode_jwt_token(token)
-            request.state.user_id = payload.get("sub")
+            payload = self.cache.get(token)
+        except Exception:
+            response = JSONResponse(status_code=401, content={"detail": "Invalid token"})
+            return await response(scope, receive, send)
+
+        self.set_user(scope, payload)
+        await self.app(scope, receive, send)
+
+    async def websocket(self, scope: Scope, receive: Receive, send: Send):
+        token = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("token", [None])[0]
+        try:
+            if not token:
+                raise ValueError("missing token")
+            payload = self.cache.get(token)
         except Exception as e:
-            logger.error("JWT decoding error: %s", e)
-            return JSONResponse(status_code=401, content={"detail": "Invalid token"})
+            logger.error("websocket auth error: %s", e)
+            return await WebSocketClose(code=1008)(scope, receive, send)
+
+        self.set_user(scope, payload)
+        await self.app(scope, receive, send)
+
+    def set_user(self, scope: Scope, payload: dict):
+        # copy so the lifespan state shared between requests is never mutated
+        scope["state"] = {**scope.get("state", {}), "user_id": payload.get("sub"),
+                          "user_tier": payload.get(settings.JWT_TIER_CLAIM)}
 
-        return await call_next(request)
-    
 def decode_jwt_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, settings.JWT_SECRET , algorithms=["HS256"],audience="authenticated")
@@ -0,0 +1,33 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api.metrics import HTTP_FAMILY, latency
+
+class MetricsMiddleware:
+    # per-route latency histograms; the route template (/status/{id}) is used
+    # as the label so ids do not blow up the number of series
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router stores the matched route on the scope
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            labels = (("method", scope["method"]), ("route", path), ("status", str(status)))
+            latency(HTTP_FAMILY, labels).observe(time.perf_counter() - start, status >= 500)
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from api.metrics import incr, register_gauge
+
+class LRUCache:
+    def __init__(self, name: str, max_entries: int):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        register_gauge(f"cache_{name}_entries", lambda: len(self._entries))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = self._entries.get(key)
+        if value is None:
+            incr(f"cache.{self.name}.misses")
+            return None
+        self._entries.move_to_end(key)
+        incr(f"cache.{self.name}.hits")
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        return self._entries.pop(key, None)
+
+class ByteLRUCache:
+    # evicts by total payload bytes; with a directory the payloads live on disk
+    # and only the index is kept in memory
+    def __init__(self, name: str, max_bytes: int, max_item_bytes: int, directory: Optional[str] = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.directory = directory
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        if directory:
+            # one directory per worker process, since the index is per process
+            self.directory = os.path.join(directory, str(os.getpid()))
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                os.unlink(os.path.join(self.directory, name))
+        register_gauge(f"cache_{name}_bytes", lambda: self.size)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    async def get(self, key: str) -> Optional[Tuple[Any, bytes]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            incr(f"cache.{self.name}.misses")
+            return None
+        meta, data, size = entry
+        if self.directory:
+            try:
+                data = await asyncio.to_thread(_read_file, self._path(key))
+            except OSError:
+                self._remove(key)
+                incr(f"cache.{self.name}.misses")
+                return None
+        self._entries.move_to_end(key)
+        incr(f"cache.{self.name}.hits")
+        return meta, data
+
+    async def put(self, key: str, meta: Any, data: bytes):
+        if len(data) > self.max_item_bytes:
+            return
+        self._remove(key)
+        if self.directory:
+            await asyncio.to_thread(_write_file, self._path(key), data)
+            self._entries[key] = (meta, None, len(data))
+        else:
+            self._entries[key] = (meta, data, len(data))
+        self.size += len(data)
+        while self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key: str):
+        self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[2]
+        if self.directory:
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _write_file(path: str, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
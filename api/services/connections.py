@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set
+
+from fastapi import WebSocket
+
+from api.config import settings
+from api.integration import pubsub
+from api.metrics import register_gauge
+
+logger = logging.getLogger(__name__)
+
+PING = "PING"
+PONG = "PONG"
+TERMINAL_MESSAGES = ("COMPLETED", "FAILED")
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+class Connection:
+    def __init__(self, job_id: str, websocket: WebSocket, max_queue: int):
+        self.job_id = job_id
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.last_seen = time.monotonic()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+
+class ConnectionManager:
+    def __init__(self, max_queue: int = 16, overflow: str = DROP_OLDEST, send_timeout: float = 5.0,
+                 ping_interval: float = 20.0, idle_timeout: float = 60.0):
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.connections: Dict[str, Set[Connection]] = {}
+        # guards the first-socket subscribe / last-socket unsubscribe transitions
+        self._lock = asyncio.Lock()
+        self._heartbeat: Optional[asyncio.Task] = None
+        register_gauge("websocket_connections", self.live_count)
+        register_gauge("websocket_queue_depth", self.queue_depth)
+
+    def live_count(self) -> int:
+        return sum(len(conns) for conns in self.connections.values())
+
+    def queue_depth(self) -> int:
+        return sum(conn.queue.qsize() for conns in self.connections.values() for conn in conns)
+
+    def start(self):
+        if not self._heartbeat:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        for conns in list(self.connections.values()):
+            for conn in list(conns):
+                await self.disconnect(conn)
+
+    async def connect(self, job_id: str, websocket: WebSocket) -> Connection:
+        conn = Connection(job_id, websocket, self.max_queue)
+        async with self._lock:
+            if job_id not in self.connections:
+                self.connections[job_id] = set()
+                await pubsub.subscribe(job_id)
+            self.connections[job_id].add(conn)
+        conn.writer = asyncio.create_task(self._writer(conn))
+        return conn
+
+    async def disconnect(self, conn: Connection, code: int = 1000):
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.writer and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        async with self._lock:
+            conns = self.connections.get(conn.job_id)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self.connections[conn.job_id]
+                    await pubsub.unsubscribe(conn.job_id)
+        try:
+            await conn.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def send(self, conn: Connection, message: str):
+        if conn.closed:
+            return
+        try:
+            conn.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if self.overflow == DISCONNECT:
+                logger.warning("websocket queue full for %s, disconnecting", conn.job_id)
+                asyncio.create_task(self.disconnect(conn, code=1013))
+                return
+            conn.queue.get_nowait()
+            conn.queue.put_nowait(message)
+
+    async def flush(self, conn: Connection):
+        # after a terminal message is queued: the writer sends it, then
+        # disconnects on its own, so wait for it rather than cancelling it
+        if conn.writer and not conn.closed:
+            await asyncio.wait({conn.writer}, timeout=self.send_timeout)
+
+    async def broadcast(self, job_id: str, message: str):
+        for conn in list(self.connections.get(job_id, ())):
+            self.send(conn, message)
+
+    def touch(self, conn: Connection):
+        conn.last_seen = time.monotonic()
+
+    async def _writer(self, conn: Connection):
+        try:
+            while True:
+                message = await conn.queue.get()
+                await asyncio.wait_for(conn.websocket.send_text(message), self.send_timeout)
+                if message in TERMINAL_MESSAGES:
+                    break
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            logger.debug("websocket send for %s failed: %s", conn.job_id, e)
+        await self.disconnect(conn)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for conns in list(self.connections.values()):
+                for conn in list(conns):
+                    if now - conn.last_seen > self.idle_timeout:
+                        await self.disconnect(conn, code=1001)
+                    else:
+                        self.send(conn, PING)
+
+manager = ConnectionManager(
+    max_queue=settings.WS_MAX_QUEUE,
+    overflow=settings.WS_OVERFLOW_POLICY,
+    send_timeout=settings.WS_SEND_TIMEOUT,
+    ping_interval=settings.WS_PING_INTERVAL,
+    idle_timeout=settings.WS_IDLE_TIMEOUT,
+)
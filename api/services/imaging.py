@@ -0,0 +1,101 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, UploadFile
+
+from api.metrics import incr, timed
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, normalization is skipped without it
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"image/png": "PNG", "image/jpeg": "JPEG"}
+MIN_SIDE = 64
+MAX_SIDE = 2048
+
+executor: Optional[ProcessPoolExecutor] = None
+
+def init_imaging(enabled: bool, workers: int):
+    global executor
+    if not enabled or executor:
+        return
+    if Image is None:
+        logger.warning("IMAGE_NORMALIZE is set but Pillow is not installed, uploads are stored as sent")
+        return
+    # workers must not be forked from this process: by the first upload it runs
+    # boto3, the S3 executor and to_thread threads, and a child could inherit a
+    # lock one of them holds. forkserver forks them from a clean process.
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+    # start the workers and load Pillow now rather than on the first upload
+    wait([executor.submit(warm_up) for _ in range(workers)])
+
+def warm_up():
+    Image.init()
+
+def close_imaging():
+    global executor
+    if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    width, height = (int(side) for side in resolution.lower().split("x", 1))
+    if not (MIN_SIDE <= width <= MAX_SIDE and MIN_SIDE <= height <= MAX_SIDE):
+        raise ValueError(f"resolution {resolution} out of range")
+    return width, height
+
+def normalize_image_sync(data: bytes, content_type: str, width: int, height: int) -> Optional[bytes]:
+    # runs in a worker process; returns None when the original is already as good
+    with Image.open(io.BytesIO(data)) as img:
+        resized = img.width > width or img.height > height
+        # apply the EXIF orientation before the metadata is dropped
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((width, height), Image.LANCZOS)
+        image_format = FORMATS[content_type]
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        # nothing from img.info is passed on, so EXIF/ICC/text chunks are stripped
+        if image_format == "JPEG":
+            img.save(out, format="JPEG", quality=90)
+        else:
+            img.save(out, format="PNG")
+    normalized = out.getvalue()
+    if not resized and len(normalized) >= len(data):
+        return None
+    return normalized
+
+async def normalize_upload(image: UploadFile, resolution: str) -> UploadFile:
+    if executor is None or image.content_type not in FORMATS:
+        return image
+    width, height = parse_resolution(resolution)
+    data = await asyncio.to_thread(image.file.read)
+    image.file.seek(0)
+    try:
+        with timed("imaging.normalize"):
+            normalized = await asyncio.get_running_loop().run_in_executor(
+                executor, normalize_image_sync, data, image.content_type, width, height)
+    except Exception as e:
+        logger.error("image normalization failed, storing original: %s", e)
+        return image
+    if normalized is None:
+        return image
+
+    saved = len(data) - len(normalized)
+    incr("imaging.bytes_in", len(data))
+    incr("imaging.bytes_saved", saved)
+    logger.info("normalized upload to %s: %d -> %d bytes (%d saved)", resolution, len(data), len(normalized), saved)
+    return UploadFile(
+        file=io.BytesIO(normalized),
+        size=len(normalized),
+        filename=image.filename,
+        headers=Headers({"content-type": image.content_type}),
+    )
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from api.config import settings
+from api.db.postgres import TaskStatus, update_status_results
+from api.integration import pubsub
+from api.metrics import incr, timed
+from api.services.cache import LRUCache
+from api.services.queue import invalidate_job
+
+logger = logging.getLogger(__name__)
+
+STATUS_RANK = {
+    TaskStatus.NEW: 0,
+    TaskStatus.IN_QUEUE: 1,
+    TaskStatus.IN_PROGRESS: 2,
+    TaskStatus.COMPLETED: 3,
+    TaskStatus.FAILED: 3,
+}
+
+# RunPod reports these as well; both are terminal failures for us
+FAILED_ALIASES = ("CANCELLED", "TIMED_OUT")
+
+def supersedes(status: TaskStatus, image_result: Optional[str], current: TaskStatus, current_result) -> bool:
+    # as in update_status_results: a more advanced status, or the same one
+    # adding a result URL it lacked
+    rank, current_rank = STATUS_RANK[status], STATUS_RANK[current]
+    return rank > current_rank or (status == current and bool(image_result) and not current_result)
+
+def parse_status(status) -> Optional[TaskStatus]:
+    if status in FAILED_ALIASES:
+        return TaskStatus.FAILED
+    return TaskStatus.__members__.get(status) if isinstance(status, str) else None
+
+class WebhookIngestor:
+    # callbacks are acknowledged as soon as they are queued here; a short flush
+    # loop folds them per job and writes each burst with one statement
+    def __init__(self, flush_interval: float = 0.05, max_batch: int = 500, state_cache_size: int = 10000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # last (status, has result) written per job, so repeats are dropped
+        # without a query
+        self.written = LRUCache("webhook_states", state_cache_size)
+        self._pending: Dict[str, Tuple[TaskStatus, Optional[str]]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # write out what was already acknowledged; the reconciler covers the rest
+        try:
+            while self._pending:
+                await self.flush_once()
+        except Exception as e:
+            logger.error("webhook final flush dropped %d updates: %s", len(self._pending), e)
+
+    def submit(self, id: str, status: TaskStatus, image_result: Optional[str] = None):
+        incr("webhook.received")
+        written = self.written.get(id)
+        if written is not None and not supersedes(status, image_result, *written):
+            incr("webhook.duplicates")
+            return
+        if not self._keep(id, status, image_result):
+            incr("webhook.duplicates")
+            return
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def _keep(self, id: str, status: TaskStatus, image_result: Optional[str]) -> bool:
+        # of two updates for one job the more advanced wins; at the same status a
+        # result URL is only ever added
+        pending = self._pending.get(id)
+        if pending is not None and not supersedes(status, image_result, *pending):
+            return False
+        self._pending[id] = (status, image_result)
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while self._pending:
+                    await self.flush_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("webhook flush error: %s", e)
+
+    async def flush_once(self):
+        ids = list(self._pending)[:self.max_batch]
+        batch = [(id, *self._pending.pop(id)) for id in ids]
+        incr("webhook.batches")
+        incr("webhook.batch_rows", len(batch))
+        try:
+            with timed("webhook.flush"):
+                changed = await update_status_results(batch)
+        except Exception:
+            # put them back unless a more advanced callback arrived meanwhile
+            for id, status, image_result in batch:
+                self._keep(id, status, image_result)
+            raise
+
+        for id, status, image_result in batch:
+            self.written.put(id, (status, image_result is not None))
+        incr("webhook.rows_changed", len(changed))
+        # only jobs whose row actually moved are pushed to websocket clients
+        for row in changed:
+            invalidate_job(row["s3_object_id"])
+            try:
+                await pubsub.publish(row["s3_object_id"], row["status"])
+            except Exception as e:
+                logger.error("webhook publish %s: %s", row["s3_object_id"], e)
+
+ingestor = WebhookIngestor(
+    flush_interval=settings.WEBHOOK_FLUSH_INTERVAL,
+    max_batch=settings.WEBHOOK_MAX_BATCH,
+    state_cache_size=settings.WEBHOOK_STATE_CACHE_SIZE,
+)
@@ -0,0 +1,65 @@
+from typing import AsyncIterator
+
+from fastapi import Request
+from starlette.datastructures import FormData, UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+# room for the prompt field and the multipart boundaries around the image
+FORM_OVERHEAD = 64 * 1024
+
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+}
+
+class UploadRejected(MultiPartException):
+    # a MultiPartException so the parser closes its spooled files on the way out
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+        super().__init__(detail)
+
+def sniff_image_type(head: bytes):
+    for signature, content_type in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return content_type
+    return None
+
+async def limited_stream(request: Request, limit: int) -> AsyncIterator[bytes]:
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > limit:
+            raise UploadRejected(413, "Image size must be less than 5MB")
+        yield chunk
+
+async def read_image_form(request: Request, max_size: int, field: str = "image") -> FormData:
+    limit = max_size + FORM_OVERHEAD
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise UploadRejected(413, "Image size must be less than 5MB")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise UploadRejected(400, "Expected multipart/form-data")
+
+    # parts are written to a spooled file as they arrive, so memory per upload is
+    # bounded by the spool size no matter how large the client claims the file is
+    parser = MultiPartParser(request.headers, limited_stream(request, limit), max_files=1, max_fields=10)
+    form = await parser.parse()
+    try:
+        image = form.get(field)
+        if not isinstance(image, UploadFile):
+            raise UploadRejected(422, f"Missing {field} file")
+        if image.size is not None and image.size > max_size:
+            raise UploadRejected(413, "Image size must be less than 5MB")
+
+        head = image.file.read(16)
+        image.file.seek(0)
+        content_type = sniff_image_type(head)
+        if content_type is None:
+            raise UploadRejected(400, "Invalid image type. Allowed types: image/jpeg, image/png")
+        image.headers = image.headers.mutablecopy()
+        image.headers["content-type"] = content_type
+    except Exception:
+        await form.close()
+        raise
+    return form
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from api.config import settings
+from api.db.postgres import TaskStatus, claim_outbox, delete_outbox, fail_stale_reservations, update_status_result
+from api.integration import pubsub
+from api.integration.sqs import send_message
+from api.metrics import timed
+from api.services.timeline import timeline
+
+logger = logging.getLogger(__name__)
+
+def trace_of(payload: str):
+    try:
+        return json.loads(payload).get("trace_id")
+    except (ValueError, AttributeError):
+        return None
+
+class OutboxRelay:
+    def __init__(self, interval: float = 1.0, batch_size: int = 10, lease: float = 30.0, max_attempts: int = 10,
+                 reservation_ttl: float = 600.0, sweep_interval: float = 30.0):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.reservation_ttl = timedelta(seconds=reservation_ttl)
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self.relay_once() == self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("outbox relay error: %s", e)
+            now = asyncio.get_running_loop().time()
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                try:
+                    await self.sweep_once()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("reservation sweep error: %s", e)
+
+    async def sweep_once(self):
+        # a request that died between admit_job and enqueue_outbox leaves a NEW
+        # row nothing would ever move; fail it once its reservation has expired
+        with timed("outbox.sweep"):
+            swept = await fail_stale_reservations(self.reservation_ttl)
+        for id in swept:
+            logger.error("job %s was admitted but never enqueued, failing it", id)
+            try:
+                await pubsub.publish(id, TaskStatus.FAILED.value)
+            except Exception as e:
+                logger.error("sweep publish %s: %s", id, e)
+
+    async def relay_once(self) -> int:
+        rows = await claim_outbox(self.batch_size, self.lease)
+        if not rows:
+            return 0
+
+        async def publish(row):
+            try:
+                with timed("outbox.publish"):
+                    await send_message(row["payload"])
+                timeline.record(row["s3_object_id"], trace_of(row["payload"]), "sqs.sent")
+                return True
+            except Exception as e:
+                logger.error("outbox publish %s failed (attempt %s): %s", row["s3_object_id"], row["attempts"], e)
+                return False
+
+        results = await asyncio.gather(*(publish(row) for row in rows))
+        done = [row["id"] for row, ok in zip(rows, results) if ok]
+        for row, ok in zip(rows, results):
+            if not ok and row["attempts"] >= self.max_attempts:
+                await update_status_result(row["s3_object_id"], TaskStatus.FAILED)
+                done.append(row["id"])
+        if done:
+            await delete_outbox(done)
+        return len(rows)
+
+relay = OutboxRelay(
+    interval=settings.OUTBOX_INTERVAL,
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    lease=settings.OUTBOX_LEASE,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    reservation_ttl=settings.ADMISSION_RESERVATION_TTL,
+    sweep_interval=settings.RESERVATION_SWEEP_INTERVAL,
+)
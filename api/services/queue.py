@@ -1,50 +1,129 @@
+import asyncio
+import base64
+import hashlib
 import json
 import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
-from api.db.postgres import TaskStatus, count_user_active_queues, get_queue_by_id_and_user, get_queues_by_user, insert_queue, update_status_result
-from api.integration.runpod import RunpodException, runpod_status
-from api.integration.s3 import get_image_froms3, upload_to_s3
-from api.integration.sqs import send_message
+from api.config import settings
+from api.db.postgres import TaskStatus, admit_job, enqueue_outbox, estimate_queues_by_user, get_queue_by_id_and_user, get_queues_by_user, memoize_job, update_status_result
+from api.integration.s3 import S3Object, get_image_froms3, object_url, presigned_get_url, upload_to_s3
 from api.integration.webhook import generate_webhook_url
+from api.metrics import incr, timed
+from api.services.cache import ByteLRUCache, LRUCache
+from api.services.imaging import normalize_upload
+from api.services.outbox import relay
+from api.services.timeline import new_trace_id, timeline
 
-class ExceededLimit():
+class ExceededLimit(Exception):
     pass
 
-class NotExists():
+class NotExists(Exception):
     pass
 
 logger = logging.getLogger(__name__)
 
-async def new_queue(userid:str,image,prompt):
-    countQueue = await count_user_active_queues(userid)
-    if countQueue>0:
+job_cache = LRUCache("jobs", settings.JOB_CACHE_SIZE)
+image_cache = ByteLRUCache("images", settings.RESULT_CACHE_BYTES, settings.RESULT_CACHE_MAX_ITEM_BYTES,
+                           settings.RESULT_CACHE_DIR)
+
+async def new_queue(userid:str,image,prompt,resolution=None,memoize=True,tier=None):
+    resolution = resolution or settings.DEFAULT_RESOLUTION
+    key = str(uuid.uuid4())
+    # follows the job through SQS, the dispatcher, RunPod and the webhook
+    trace_id = new_trace_id()
+    received = datetime.now(timezone.utc)
+    file_url = object_url(key)
+    # the slot is reserved atomically before any upload work is done
+    with timed("queue.admit"):
+        admitted = await admit_job(key, userid, prompt, file_url, settings.MAX_ACTIVE_JOBS_PER_USER,
+                                   timedelta(seconds=settings.ADMISSION_RESERVATION_TTL))
+    if not admitted:
         raise ExceededLimit("Another request is still in the queue or in progress")
+    # recorded only now so rejected requests leave no events for a job that
+    # never existed; stamped with the arrival time
+    timeline.record(key, trace_id, "api.received", received)
     try:
-        keys = await upload_to_s3(image)
-        key = keys[0]
-        file_url = keys[1]
-        
-        webhook_url = generate_webhook_url(key)
+        image = await normalize_upload(image, resolution)
+        if settings.RESULT_MEMOIZATION:
+            with timed("queue.hash"):
+                # the user is part of the hash unless results are shared, so a
+                # lookup only ever matches the user's own jobs
+                scope = "" if settings.RESULT_MEMOIZATION_SHARED else userid
+                content_hash = await hash_submission(image, prompt, resolution, settings.WORKFLOW_NAME, scope)
+            with timed("queue.memoize"):
+                hit = await memoize_job(key, content_hash, memoize,
+                                        timedelta(seconds=settings.ADMISSION_RESERVATION_TTL))
+            if hit:
+                # finished or being followed, nothing to run
+                incr("queue.memo_hits")
+                timeline.record(key, trace_id, "api.memoized")
+                logger.info("job %s memoized onto %s (%s)", key, hit["hit_id"], hit["hit_status"])
+                return key
+        await upload_to_s3(image, key)
+
+        webhook_url = generate_webhook_url(key, trace_id)
         payload = {
             "image_key": key,
             "prompt": prompt,
+            "resolution": resolution,
+            "workflow_name": settings.WORKFLOW_NAME,
+            "userid": userid,
+            "tier": tier,
+            "trace_id": trace_id,
             "webhook": webhook_url
         }
-        await send_message(json.dumps(payload))
-
-        await insert_queue(key,userid,prompt,file_url)
+        # published to SQS by the outbox relay once this row is committed
+        with timed("queue.enqueue"):
+            enqueued = await enqueue_outbox(key, json.dumps(payload))
+        if not enqueued:
+            raise RuntimeError(f"reservation for {key} expired before it was enqueued")
+        timeline.record(key, trace_id, "api.enqueued")
+        relay.wake()
         return key
     except Exception as e:
         logger.error("new_queue Error: %s", str(e))
+        try:
+            await update_status_result(key, TaskStatus.FAILED)
+        except Exception as release_error:
+            logger.error("new_queue release %s: %s", key, release_error)
         raise e
-    #except S3Exception as s3e:
-    #    raise e
 
-async def queues_by_user(userid):
-    return await get_queues_by_user(userid)
+def hash_submission_sync(file, prompt, resolution, workflow_name, scope):
+    digest = hashlib.sha256()
+    for part in (scope, workflow_name, resolution, prompt):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    for chunk in iter(lambda: file.read(settings.S3_STREAM_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+async def hash_submission(image, prompt, resolution, workflow_name, scope):
+    return await asyncio.to_thread(hash_submission_sync, image.file, prompt, resolution, workflow_name, scope)
+
+def encode_cursor(row) -> str:
+    raw = f"{row['created_on'].isoformat()}|{row['s3_object_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-async def update_status(id,status,image_result):
-    await update_status_result(id,TaskStatus[status],image_result)
+def decode_cursor(cursor: str):
+    created_on, s3_object_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    return datetime.fromisoformat(created_on), s3_object_id
+
+async def queues_by_user(userid, limit, before=None, with_total=False):
+    cursor = decode_cursor(before) if before else None
+    rows = await get_queues_by_user(userid, limit, cursor)
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+    total = await estimate_queues_by_user(userid) if with_total else None
+    return rows, next_cursor, total
+
+def invalidate_job(id):
+    cached = job_cache.pop(id)
+    if cached and cached[2]:
+        image_cache.invalidate(result_object_key(cached[2]))
 
 async def get_pending_queue(id,userid):
     queue = await get_queue_by_id_and_user(id,userid)
@@ -55,39 +134,103 @@ async def get_pending_queue(id,userid):
     return queue
     
         
+TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
 async def get_latest_status(id,userid):
+    # terminal jobs never change again, so they are answered from memory
+    cached = job_cache.get(id)
+    if cached and cached[0] == userid:
+        return cached[1], cached[2]
+
+    # active jobs are kept up to date by the webhook and the background reconciler,
+    # so the stored row is authoritative and RunPod is never called from here
     try:
-        queue = await get_queue_by_id_and_user(id,userid)
+        with timed("db.get_queue"):
+            queue = await get_queue_by_id_and_user(id,userid)
         if not queue:
             raise NotExists("Not Found")
-        
+
         status = TaskStatus[queue["status"]]
-        image_result = queue.get("image_result")
-        latestStatus = None        
-        if status == TaskStatus.IN_PROGRESS or status == TaskStatus.IN_QUEUE:
-            runpodStatus, result_url = await runpod_status(queue["runpod_id"])
-            latestStatus = TaskStatus[runpodStatus]
-            if status != latestStatus:
-                await update_status_result(id,latestStatus,result_url)
-            if latestStatus == TaskStatus.COMPLETED:
-                image_result = result_url
-        else:
-            latestStatus = status
-        
-        if latestStatus ==  TaskStatus.COMPLETED:
-            file_stream = await get_image(image_result)
-            return latestStatus.value,file_stream
-        else:
-            return latestStatus.value , None
-    except RunpodException as re:
-        logger.error("Runpod status: %s", str(re))
-        await update_status_result(id,TaskStatus.FAILED)
-        raise re
+        image_result = queue.get("image_result") if status == TaskStatus.COMPLETED else None
+        if status in TERMINAL_STATUSES:
+            job_cache.put(id, (userid, status.value, image_result))
+        return status.value, image_result
     except Exception as e:
         logger.error("get_latest_status : %s", str(e))
         raise e
 
-async def get_image(image_result):
+def result_object_key(image_result):
     parsed_url = urlparse(image_result)
-    object_key = parsed_url.path.lstrip('/')
-    return await get_image_froms3(object_key)
\ No newline at end of file
+    return parsed_url.path.lstrip('/')
+
+async def get_image(image_result, if_none_match=None, byte_range=None):
+    key = result_object_key(image_result)
+    cached = await image_cache.get(key)
+    if cached:
+        (etag, content_type), data = cached
+        return cached_object(data, etag, content_type, if_none_match, byte_range)
+
+    image = await get_image_froms3(key, if_none_match, byte_range)
+    if image.status_code == 200 and image.content_length and image.content_length <= image_cache.max_item_bytes:
+        image.body = fill_cache(image.body, key, image.etag, image.content_type)
+    return image
+
+async def fill_cache(body, key, etag, content_type):
+    # stream to the client and keep a copy; only complete bodies are cached.
+    # When the client goes away this generator is closed early and the S3
+    # stream (and its executor slot) is released with it.
+    chunks = []
+    try:
+        async for chunk in body:
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, "aclose"):
+            await body.aclose()
+    await image_cache.put(key, (etag, content_type), b"".join(chunks))
+
+def parse_range(byte_range, size):
+    start, _, end = byte_range[len("bytes="):].partition("-")
+    if not start:
+        if not end:
+            return None
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+async def iter_bytes(data):
+    chunk_size = settings.S3_STREAM_CHUNK_SIZE
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+def cached_object(data, etag, content_type, if_none_match=None, byte_range=None):
+    if if_none_match and etag and if_none_match == etag:
+        return S3Object(304, None, etag=etag)
+    if byte_range:
+        bounds = parse_range(byte_range, len(data))
+        if bounds is None:
+            return S3Object(416, None, etag=etag)
+        start, end = bounds
+        return S3Object(206, iter_bytes(data[start:end + 1]), etag=etag, content_type=content_type,
+                        content_length=end - start + 1, content_range=f"bytes {start}-{end}/{len(data)}")
+    return S3Object(200, iter_bytes(data), etag=etag, content_type=content_type, content_length=len(data))
+
+_presigned_urls = OrderedDict()
+
+def get_image_url(image_result):
+    # reuse a signed URL until it is close to expiring so browsers can cache the redirect
+    key = result_object_key(image_result)
+    now = time.time()
+    cached = _presigned_urls.get(key)
+    if cached and cached[0] - now > settings.PRESIGNED_URL_MIN_REMAINING:
+        _presigned_urls.move_to_end(key)
+        return cached[1], int(cached[0] - now)
+    expires_at = now + settings.PRESIGNED_URL_TTL
+    url = presigned_get_url(key, settings.PRESIGNED_URL_TTL)
+    _presigned_urls[key] = (expires_at, url)
+    if len(_presigned_urls) > settings.PRESIGNED_URL_CACHE_SIZE:
+        _presigned_urls.popitem(last=False)
+    return url, settings.PRESIGNED_URL_TTL
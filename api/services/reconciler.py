@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from api.db import postgres
+from api.db.postgres import TaskStatus, get_active_queues, update_status_results
+from api.integration.runpod import RunpodException, runpod_job_status
+from api.metrics import register_gauge, timed
+from api.services.timeline import record_finished
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK = "runpod_reconciler"
+
+def to_task_status(runpod_status: str) -> TaskStatus:
+    # RunPod also reports CANCELLED and TIMED_OUT, both terminal failures for us
+    return TaskStatus.__members__.get(runpod_status, TaskStatus.FAILED)
+
+class Reconciler:
+    def __init__(self, notify: Callable[[str, str], Awaitable[None]], interval: float = 1.0,
+                 min_poll: float = 2.0, max_poll: float = 30.0, backoff: float = 0.1, concurrency: int = 10,
+                 election_interval: float = 10.0):
+        self.notify = notify
+        self.interval = interval
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.concurrency = concurrency
+        self.election_interval = election_interval
+        self._next_check: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        # every uvicorn worker runs a Reconciler; the one whose session holds
+        # the advisory lock polls, so RunPod sees one poller however many run
+        self._lock_conn = None
+        self._next_election = 0.0
+        register_gauge("reconciler_leader", lambda: int(self.is_leader()))
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock_conn:
+            conn, self._lock_conn = self._lock_conn, None
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error("reconciler lock release: %s", e)
+
+    def is_leader(self) -> bool:
+        return self._lock_conn is not None and not self._lock_conn.is_closed()
+
+    async def elect(self) -> bool:
+        if self.is_leader():
+            return True
+        now = time.monotonic()
+        if now < self._next_election:
+            return False
+        self._next_election = now + self.election_interval
+        self._lock_conn = None
+        conn = await postgres.connect_session()
+        try:
+            if await postgres.try_advisory_lock(conn, LEADER_LOCK):
+                logger.info("reconciler lock acquired, polling RunPod from this worker")
+                self._lock_conn, conn = conn, None
+                return True
+            return False
+        finally:
+            if conn:
+                await conn.close()
+
+    def poll_interval(self, age_seconds: float) -> float:
+        # new jobs are checked often, long-running ones progressively less
+        return min(self.max_poll, max(self.min_poll, age_seconds * self.backoff))
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.elect():
+                    await self.reconcile_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("reconcile error: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def reconcile_once(self):
+        with timed("reconciler.select"):
+            rows = await get_active_queues()
+        now = time.monotonic()
+        active = {row["s3_object_id"] for row in rows}
+        for id in [id for id in self._next_check if id not in active]:
+            del self._next_check[id]
+
+        due = [row for row in rows if self._next_check.get(row["s3_object_id"], 0) <= now]
+        if not due:
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(row):
+            async with semaphore:
+                self._next_check[row["s3_object_id"]] = now + self.poll_interval(row["age_seconds"])
+                try:
+                    status, result_url, execution_ms = await runpod_job_status(row["runpod_id"], row["s3_object_id"])
+                    return to_task_status(status), result_url, execution_ms
+                except RunpodException as re:
+                    logger.error("Runpod status %s: %s", row["s3_object_id"], re)
+                    return TaskStatus.FAILED, None, None
+                except Exception as e:
+                    logger.error("Runpod status %s: %s", row["s3_object_id"], e)
+                    return None
+
+        results = await asyncio.gather(*(check(row) for row in due))
+        updates = []
+        execution = {}
+        for row, result in zip(due, results):
+            if result is None or result[0].value == row["status"]:
+                continue
+            updates.append((row["s3_object_id"], result[0], result[1]))
+            execution[row["s3_object_id"]] = result[2]
+        if not updates:
+            return
+
+        with timed("reconciler.update"):
+            changed = await update_status_results(updates)
+        for row in changed:
+            id = row["s3_object_id"]
+            if row["status"] in (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value):
+                # the only finish batched jobs get, as they have no webhook. Found
+                # by polling, so up to one poll late: runpod.started is counted
+                # back from it and the lag lands in the runpod queue stage
+                record_finished(id, None, execution.get(id))
+            try:
+                await self.notify(id, row["status"])
+            except Exception as e:
+                logger.error("reconcile notify %s: %s", id, e)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from api.config import settings
+from api.db.postgres import TaskStatus, insert_job_events
+from api.metrics import incr
+
+logger = logging.getLogger(__name__)
+
+# the stages reported by `python -m api.db.timeline`, as (stage, from, to);
+# events are written by the API, the outbox relay, the Lambda or dispatcher
+# (record_job_events in lambda_function.py) and the webhook
+STAGES = [
+    ("admission+upload", "api.received", "api.enqueued"),
+    ("outbox", "api.enqueued", "sqs.sent"),
+    ("sqs dwell", "sqs.sent", "dispatch.received"),
+    ("fair-share wait", "dispatch.received", "dispatch.slot"),
+    ("runpod submit", "dispatch.received", "runpod.submitted"),
+    ("runpod queue", "runpod.submitted", "runpod.started"),
+    ("gpu execution", "runpod.started", "runpod.finished"),
+    ("total", "api.received", "runpod.finished"),
+]
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+class TimelineRecorder:
+    # events are telemetry: record() never waits on the database, and rows
+    # that cannot be written are dropped instead of piling up
+    def __init__(self, enabled: bool = True, flush_interval: float = 1.0, max_pending: int = 10000):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: List[Tuple[str, Optional[str], str, datetime]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.enabled and not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush_once()
+        except Exception as e:
+            logger.error("timeline final flush: %s", e)
+
+    def record(self, id: str, trace_id: Optional[str], event: str, at: Optional[datetime] = None):
+        if not self.enabled:
+            return
+        if len(self._pending) >= self.max_pending:
+            incr("timeline.dropped")
+            return
+        self._pending.append((id, trace_id, event, at or datetime.now(timezone.utc)))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("timeline flush error: %s", e)
+
+    async def flush_once(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await insert_job_events(batch)
+        except Exception:
+            incr("timeline.dropped", len(batch))
+            raise
+        incr("timeline.events", len(batch))
+
+def record_finished(id: str, trace_id: Optional[str], execution_ms):
+    # RunPod reports executionTime (ms) for a finished job; counting back from
+    # now splits RunPod queueing from GPU time
+    now = datetime.now(timezone.utc)
+    if isinstance(execution_ms, (int, float)) and execution_ms >= 0:
+        timeline.record(id, trace_id, "runpod.started", now - timedelta(milliseconds=execution_ms))
+    timeline.record(id, trace_id, "runpod.finished", now)
+
+def record_webhook(id: str, trace_id: Optional[str], status: TaskStatus, data: dict):
+    if status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
+        record_finished(id, trace_id, data.get("executionTime"))
+
+timeline = TimelineRecorder(
+    enabled=settings.TIMELINE_ENABLED,
+    flush_interval=settings.TIMELINE_FLUSH_INTERVAL,
+    max_pending=settings.TIMELINE_MAX_PENDING,
+)
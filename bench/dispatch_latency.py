@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+
+for name, value in {
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}.items():
+    os.environ.setdefault(name, value)
+
+import boto3  # noqa: E402
+from aiohttp import web  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import lambda_function  # noqa: E402
+import workflow  # noqa: E402
+from dispatcher import Dispatcher  # noqa: E402
+
+# 1x1 PNG, the content does not matter to the fake RunPod
+IMAGE = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+
+class FakeDatabase:
+    # stands in for lambda_function.Database; one connection, so writes serialise
+    def __init__(self, latency, finished=lambda key: True):
+        self.latency = latency
+        self.finished = finished
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.rows = 0
+
+    def execute(self, query, params):
+        self._write(1)
+
+    def execute_values(self, query, rows):
+        self._write(len(rows))
+
+    def fetch(self, query, params):
+        self._write(0)
+        return [(key,) for key in params[0] if self.finished(key)]
+
+    def _write(self, rows):
+        with self.lock:
+            time.sleep(self.latency)
+            self.statements += 1
+            self.rows += rows
+
+
+class FakeRunpod:
+    # records when each job reaches "the GPU"; jobs are matched by their webhook URL
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = {}
+        self.arrived = {}
+        self.loop = asyncio.new_event_loop()
+        self.url = None
+
+    async def run(self, request):
+        body = json.loads(await request.read())
+        key = body["webhook"].rsplit("/", 1)[-1]
+        self.arrived.setdefault(key, time.perf_counter())
+        await asyncio.sleep(self.latency)
+        return web.json_response({"id": f"rp-{key}", "status": "IN_QUEUE"})
+
+    async def webhook(self, request):
+        return web.Response(status=200)
+
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            app = web.Application(client_max_size=64 * 1024 * 1024)
+            app.router.add_post("/run", self.run)
+            app.router.add_post("/webhook/{key}", self.webhook)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            ready.set()
+
+        threading.Thread(target=lambda: (self.loop.run_until_complete(serve()), self.loop.run_forever()),
+                         daemon=True).start()
+        ready.wait()
+
+
+def setup_aws(runpod_url):
+    boto3.client("s3").create_bucket(Bucket=workflow.BUCKET_NAME)
+    secrets = boto3.client("secretsmanager")
+    secrets.create_secret(Name="runpod", SecretString=json.dumps({"api_url": f"{runpod_url}/run", "api_token": "bench"}))
+    secrets.create_secret(Name="postgres", SecretString=json.dumps({}))
+    return boto3.client("sqs").create_queue(QueueName=f"bench-{uuid.uuid4().hex[:8]}")["QueueUrl"]
+
+
+def enqueue(sqs, queue_url, runpod, jobs, rate):
+    s3 = boto3.client("s3")
+    keys = [str(uuid.uuid4()) for _ in range(jobs)]
+    for key in keys:
+        s3.put_object(Bucket=workflow.BUCKET_NAME, Key=key, Body=IMAGE)
+    interval = 1 / rate if rate else 0
+    start = time.perf_counter()
+    for i, key in enumerate(keys):
+        if interval:
+            time.sleep(max(0, start + i * interval - time.perf_counter()))
+        body = {"image_key": key, "prompt": "a watercolor fox", "webhook": f"{runpod.url}/webhook/{key}"}
+        runpod.sent[key] = time.perf_counter()
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(body))
+    return keys
+
+
+def lambda_path(queue_url, runpod, db, jobs, rate, consumers, invoke_overhead):
+    # emulates the SQS event source mapping: pollers that hand batches to lambda_handler
+    lambda_function._db = db
+    sqs = boto3.client("sqs")
+    stop = threading.Event()
+
+    def consume():
+        while not stop.is_set():
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10,
+                                           WaitTimeSeconds=1).get("Messages", [])
+            if not messages:
+                continue
+            time.sleep(invoke_overhead)
+            event = {"Records": [{"messageId": m["MessageId"], "receiptHandle": m["ReceiptHandle"], "body": m["Body"]}
+                                 for m in messages]}
+            failed = {f["itemIdentifier"] for f in lambda_function.lambda_handler(event, None)["batchItemFailures"]}
+            done = [{"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]}
+                    for i, m in enumerate(messages) if m["MessageId"] not in failed]
+            if done:
+                sqs.delete_message_batch(QueueUrl=queue_url, Entries=done)
+
+    threads = [threading.Thread(target=consume, daemon=True) for _ in range(consumers)]
+    for t in threads:
+        t.start()
+    keys = enqueue(sqs, queue_url, runpod, jobs, rate)
+    wait_for(runpod, keys)
+    stop.set()
+    for t in threads:
+        t.join()
+    return keys
+
+
+def dispatcher_path(queue_url, runpod, db, jobs, rate, concurrency, endpoint_concurrency):
+    sqs = boto3.client("sqs")
+    result = {}
+
+    async def run():
+        dispatcher = Dispatcher(sqs, queue_url, db, concurrency=concurrency, wait_time=1,
+                                endpoint_concurrency=endpoint_concurrency, slot_poll_interval=0.05)
+        task = asyncio.create_task(dispatcher.run())
+        result["keys"] = await asyncio.to_thread(enqueue, sqs, queue_url, runpod, jobs, rate)
+        await asyncio.to_thread(wait_for, runpod, result["keys"])
+        dispatcher.stop()
+        await task
+
+    asyncio.run(run())
+    return result["keys"]
+
+
+def wait_for(runpod, keys, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not all(key in runpod.arrived for key in keys):
+        time.sleep(0.01)
+
+
+def report(name, runpod, keys, db):
+    latencies = sorted((runpod.arrived[k] - runpod.sent[k]) * 1000 for k in keys if k in runpod.arrived)
+    if not latencies:
+        print(f"{name:<10} no job reached RunPod")
+        return
+    q = statistics.quantiles(latencies, n=100)
+    span = max(runpod.arrived[k] for k in keys if k in runpod.arrived) - min(runpod.sent[k] for k in keys)
+    print(f"{name:<10} {len(latencies)}/{len(keys)} jobs  p50 {q[49]:7.1f} ms  p95 {q[94]:7.1f} ms  "
+          f"p99 {q[98]:7.1f} ms  {len(latencies) / span:6.1f} jobs/s  {db.statements} DB statements")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQS-to-RunPod latency, Lambda handler vs dispatcher")
+    parser.add_argument("--jobs", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=100, help="jobs per second sent to SQS, 0 for a burst")
+    parser.add_argument("--runpod-latency", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.005)
+    parser.add_argument("--lambda-consumers", type=int, default=5)
+    parser.add_argument("--invoke-overhead", type=float, default=0.0,
+                        help="seconds added per Lambda invocation; cold starts are not modelled otherwise")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--endpoint-concurrency", type=int, default=32,
+                        help="dispatcher ceiling on GPU jobs in flight")
+    parser.add_argument("--gpu-time", type=float, default=0.2,
+                        help="seconds a job holds its GPU slot after reaching RunPod")
+    args = parser.parse_args()
+
+    with mock_aws():
+        runpod = FakeRunpod(args.runpod_latency)
+        runpod.start()
+        queue_url = setup_aws(runpod.url)
+
+        db = FakeDatabase(args.db_latency)
+        keys = lambda_path(queue_url, runpod, db, args.jobs, args.rate, args.lambda_consumers, args.invoke_overhead)
+        report("lambda", runpod, keys, db)
+
+        def finished(key):
+            arrived = runpod.arrived.get(key)
+            return arrived is not None and time.perf_counter() - arrived > args.gpu_time
+
+        db = FakeDatabase(args.db_latency, finished)
+        keys = dispatcher_path(queue_url, runpod, db, args.jobs, args.rate, args.concurrency,
+                               args.endpoint_concurrency)
+        report("dispatcher", runpod, keys, db)
+
+
+if __name__ == "__main__":
+    main()
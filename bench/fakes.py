@@ -0,0 +1,318 @@
+import asyncio
+import itertools
+import json
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+
+from api.config import settings
+from api.integration.s3 import S3Object, object_url
+from api.metrics import timed
+
+# in-process stand-ins for api.db.postgres, api.integration.s3 and
+# api.integration.sqs. install() must run before api.app is imported: the
+# services bind these functions by name when they are first imported.
+
+RANK = {"NEW": 0, "IN_QUEUE": 1, "IN_PROGRESS": 2, "COMPLETED": 3, "FAILED": 3}
+
+
+class FakeSession:
+    # a connection from connect_session; closing it drops its advisory locks
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+        self.db.locks = {name: conn for name, conn in self.db.locks.items() if conn is not self}
+
+
+class FakePostgres:
+    # the queue and outbox tables as dicts; every call holds one of pool_size
+    # connections for `latency` seconds, like an asyncpg round trip
+    def __init__(self, latency, pool_size=10):
+        self.latency = latency
+        self.pool = asyncio.Semaphore(pool_size)
+        self.rows = {}
+        self.by_user = {}
+        self.followers = {}
+        self.outbox = {}
+        self.outbox_ids = itertools.count(1)
+        self.events = 0
+        self.locks = {}
+
+    async def _roundtrip(self):
+        async with self.pool:
+            await asyncio.sleep(self.latency)
+
+    async def init_db(self):
+        pass
+
+    async def admit_job(self, s3_object_id, userid, prompt, image_input, max_active, reservation_ttl):
+        await self._roundtrip()
+        now = datetime.now(timezone.utc)
+        active = sum(1 for id in self.by_user.get(userid, ())
+                     if self.rows[id]["status"] in ("IN_QUEUE", "IN_PROGRESS")
+                     or (self.rows[id]["status"] == "NEW" and self.rows[id]["created_on"] > now - reservation_ttl))
+        if active >= max_active:
+            return False
+        self.rows[s3_object_id] = {
+            "s3_object_id": s3_object_id, "userid": userid, "status": "NEW", "prompt": prompt,
+            "image_input": image_input, "image_result": None, "runpod_id": None, "content_hash": None,
+            "memo_of": None, "enqueued_on": None, "created_on": now, "updated_on": now,
+        }
+        self.by_user.setdefault(userid, []).append(s3_object_id)
+        return True
+
+    async def memoize_job(self, s3_object_id, content_hash, lookup, reservation_ttl):
+        await self._roundtrip()
+        row = self.rows[s3_object_id]
+        row["content_hash"] = content_hash
+        if not lookup:
+            return None
+        now = datetime.now(timezone.utc)
+        hits = [r for r in self.rows.values()
+                if r["content_hash"] == content_hash and r["memo_of"] is None and r is not row
+                and (r["status"] in ("COMPLETED", "IN_QUEUE", "IN_PROGRESS")
+                     or (r["status"] == "NEW" and r["created_on"] > now - reservation_ttl))]
+        if not hits:
+            return None
+        hit = max(hits, key=lambda r: (r["status"] == "COMPLETED", r["created_on"]))
+        row.update(memo_of=hit["s3_object_id"], status=hit["status"], image_result=hit["image_result"],
+                   image_input=hit["image_input"], updated_on=now)
+        self.followers.setdefault(hit["s3_object_id"], []).append(s3_object_id)
+        return {"hit_id": hit["s3_object_id"], "hit_status": hit["status"], "hit_image_result": hit["image_result"]}
+
+    async def enqueue_outbox(self, s3_object_id, payload):
+        await self._roundtrip()
+        row = self.rows[s3_object_id]
+        if row["status"] != "NEW":
+            return False
+        row["enqueued_on"] = datetime.now(timezone.utc)
+        id = next(self.outbox_ids)
+        self.outbox[id] = {"id": id, "s3_object_id": s3_object_id, "payload": payload, "attempts": 0,
+                           "available_on": 0.0}
+        return True
+
+    async def fail_stale_reservations(self, reservation_ttl):
+        await self._roundtrip()
+        cutoff = datetime.now(timezone.utc) - reservation_ttl
+        swept = []
+        for id, row in self.rows.items():
+            if (row["status"] == "NEW" and row["enqueued_on"] is None and row["memo_of"] is None
+                    and row["created_on"] < cutoff):
+                swept += [id] + self._set(id, "FAILED", None)
+        return swept
+
+    async def claim_outbox(self, limit, lease):
+        await self._roundtrip()
+        now = asyncio.get_running_loop().time()
+        claimed = []
+        for row in self.outbox.values():
+            if len(claimed) == limit:
+                break
+            if row["available_on"] <= now:
+                row["attempts"] += 1
+                row["available_on"] = now + lease.total_seconds() * row["attempts"]
+                claimed.append(dict(row))
+        return claimed
+
+    async def delete_outbox(self, ids):
+        await self._roundtrip()
+        for id in ids:
+            self.outbox.pop(id, None)
+
+    def _set(self, s3_object_id, status, image_result):
+        row = self.rows[s3_object_id]
+        row["status"] = status
+        row["image_result"] = image_result or row["image_result"]
+        row["updated_on"] = datetime.now(timezone.utc)
+        # what the propagate_memoized_status trigger does
+        followers = self.followers.get(s3_object_id, [])
+        for id in followers:
+            self.rows[id].update(status=row["status"], image_result=row["image_result"])
+        return followers
+
+    async def update_status_result(self, s3_object_id, status, image_result=None):
+        await self._roundtrip()
+        if s3_object_id not in self.rows:
+            return []
+        return list(self._set(s3_object_id, status.value, image_result))
+
+    async def update_status_results(self, updates):
+        await self._roundtrip()
+        changed = []
+        for id, status, image_result in updates:
+            row = self.rows.get(id)
+            if row is None:
+                continue
+            # as the WHERE clause: move forward, or fill a missing result at the same status
+            fills = row["status"] == status.value and image_result and not row["image_result"]
+            if RANK[row["status"]] >= RANK[status.value] and not fills:
+                continue
+            changed.append({"s3_object_id": id, "status": status.value})
+            changed += [{"s3_object_id": f, "status": status.value} for f in self._set(id, status.value, image_result)]
+        return changed
+
+    def set_runpod_id(self, s3_object_id, runpod_id):
+        # what the dispatcher writes after RunPod accepted the job
+        row = self.rows.get(s3_object_id)
+        if row is not None:
+            row["runpod_id"] = runpod_id
+            if RANK[row["status"]] < RANK["IN_QUEUE"]:
+                self._set(s3_object_id, "IN_QUEUE", None)
+
+    async def get_active_queues(self):
+        await self._roundtrip()
+        now = datetime.now(timezone.utc)
+        return [{"s3_object_id": r["s3_object_id"], "runpod_id": r["runpod_id"], "status": r["status"],
+                 "age_seconds": (now - r["created_on"]).total_seconds()}
+                for r in self.rows.values() if r["status"] in ("IN_QUEUE", "IN_PROGRESS") and r["runpod_id"]]
+
+    async def get_queues_by_user(self, userid, limit, before=None):
+        await self._roundtrip()
+        rows = []
+        for id in reversed(self.by_user.get(userid, [])):
+            row = self.rows[id]
+            if before is not None and (row["created_on"], id) >= tuple(before):
+                continue
+            rows.append({"s3_object_id": id, "status": row["status"], "created_on": row["created_on"],
+                         "created_on_text": row["created_on"].strftime("%Y-%m-%d %H:%M")})
+            if len(rows) == limit:
+                break
+        return rows
+
+    async def estimate_queues_by_user(self, userid):
+        await self._roundtrip()
+        return len(self.by_user.get(userid, ()))
+
+    async def get_queue_by_id_and_user(self, s3_object_id, userid):
+        await self._roundtrip()
+        row = self.rows.get(s3_object_id)
+        return dict(row) if row and row["userid"] == userid else None
+
+    async def connect_session(self):
+        return FakeSession(self)
+
+    async def try_advisory_lock(self, conn, name):
+        return self.locks.setdefault(name, conn) is conn
+
+    async def insert_job_events(self, events):
+        await self._roundtrip()
+        self.events += len(events)
+
+    FUNCTIONS = ("init_db", "admit_job", "memoize_job", "enqueue_outbox", "fail_stale_reservations", "claim_outbox",
+                 "delete_outbox", "update_status_result", "update_status_results", "get_active_queues",
+                 "get_queues_by_user", "estimate_queues_by_user", "get_queue_by_id_and_user", "connect_session",
+                 "try_advisory_lock", "insert_job_events")
+
+
+class FakeS3:
+    # uploads are read and dropped; every result key serves the same blob
+    def __init__(self, latency, bandwidth, result_bytes):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.result = b"\x89PNG\r\n\x1a\n" + b"\0" * max(0, result_bytes - 8)
+        self.uploaded_bytes = 0
+
+    def init_s3(self):
+        pass
+
+    def close_s3(self):
+        pass
+
+    async def upload_to_s3(self, image, key=None):
+        key = key or str(uuid.uuid4())
+        with timed("s3.upload"):
+            size = 0
+            for chunk in iter(lambda: image.file.read(settings.S3_STREAM_CHUNK_SIZE), b""):
+                size += len(chunk)
+            await asyncio.sleep(self.latency + size / self.bandwidth)
+        self.uploaded_bytes += size
+        return [key, object_url(key)]
+
+    async def get_image_froms3(self, object_key, if_none_match=None, byte_range=None):
+        with timed("s3.get_object"):
+            await asyncio.sleep(self.latency)
+        etag = '"bench"'
+        if if_none_match == etag:
+            return S3Object(304, None, etag=etag)
+        return S3Object(200, self._body(), etag=etag, content_type="image/png", content_length=len(self.result))
+
+    async def _body(self):
+        size = settings.S3_STREAM_CHUNK_SIZE
+        for start in range(0, len(self.result), size):
+            chunk = self.result[start:start + size]
+            await asyncio.sleep(len(chunk) / self.bandwidth)
+            yield chunk
+
+    def presigned_get_url(self, object_key, expires_in):
+        return f"https://{settings.S3_BUCKET_NAME}.s3.local/{object_key}?X-Amz-Expires={expires_in}"
+
+    FUNCTIONS = ("init_s3", "close_s3", "upload_to_s3", "get_image_froms3", "presigned_get_url")
+
+
+class FakeSqs:
+    # a send is acknowledged after `latency`; the message then goes to a
+    # stand-in for the dispatcher, which submits it to RunPod, stores the
+    # runpod_id and posts the IN_QUEUE webhook as lambda_function does
+    def __init__(self, latency, runpod_url, db):
+        self.latency = latency
+        self.runpod_url = runpod_url
+        self.db = db
+        self.session = None
+        self.tasks = set()
+        self.sent = 0
+
+    def init_sqs(self):
+        pass
+
+    async def close_sqs(self):
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def send_message(self, message):
+        with timed("sqs.flush"):
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        task = asyncio.create_task(self.dispatch(json.loads(message)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return str(uuid.uuid4())
+
+    async def dispatch(self, message):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        body = {"input": {"prompt": message["prompt"], "image_key": message["image_key"]},
+                "webhook": message["webhook"]}
+        try:
+            async with self.session.post(f"{self.runpod_url}/run", json=body) as response:
+                runpod_id = (await response.json()).get("id")
+            self.db.set_runpod_id(message["image_key"], runpod_id)
+            async with self.session.post(message["webhook"], json={"status": "IN_QUEUE"}) as response:
+                await response.read()
+        except Exception as e:
+            print(f"fake dispatcher: {message['image_key']}: {e}")
+
+    FUNCTIONS = ("init_sqs", "close_sqs", "send_message")
+
+
+def install(runpod_url, db_latency=0.002, db_pool_size=10, s3_latency=0.02, s3_bandwidth=100e6,
+            result_bytes=256 * 1024, sqs_latency=0.01):
+    from api.db import postgres
+    from api.integration import s3, sqs
+
+    db = FakePostgres(db_latency, db_pool_size)
+    fakes = [(postgres, db), (s3, FakeS3(s3_latency, s3_bandwidth, result_bytes)),
+             (sqs, FakeSqs(sqs_latency, runpod_url, db))]
+    for module, fake in fakes:
+        for name in fake.FUNCTIONS:
+            setattr(module, name, getattr(fake, name))
+    return [fake for _, fake in fakes]
@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import time
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from jose import jwt
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.routing import Route
+
+from api.config import settings
+from api.middleware.jwt import JWTAuthMiddleware, decode_jwt_token
+
+
+class LegacyJWTAuthMiddleware(BaseHTTPMiddleware):
+    # the BaseHTTPMiddleware implementation this benchmark compares against
+    async def dispatch(self, request: Request, call_next):
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            return JSONResponse(status_code=401, content={"detail": "Invalid or missing Authorization header"})
+        try:
+            payload = decode_jwt_token(auth_header[7:])
+            request.state.user_id = payload.get("sub")
+        except Exception:
+            return JSONResponse(status_code=401, content={"detail": "Invalid token"})
+        return await call_next(request)
+
+
+async def image(request):
+    async def body():
+        for _ in range(16):
+            yield b"\0" * 65536
+    return StreamingResponse(body(), media_type="image/png")
+
+
+def build_app(middleware):
+    return Starlette(routes=[Route("/status/job", image)], middleware=[Middleware(middleware)])
+
+
+async def run(app, token: str, requests: int) -> float:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/status/job", "raw_path": b"/status/job", "query_string": b"",
+        "root_path": "", "headers": [(b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 80),
+    }
+
+    def receiver():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                # the client never disconnects; the response cancels this wait when done
+                await asyncio.Event().wait()
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        return receive
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receiver(), send)
+    return (time.perf_counter() - start) / requests
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Per-request overhead of the JWT middleware")
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    token = jwt.encode({"sub": "bench-user", "aud": "authenticated", "exp": int(time.time()) + 3600},
+                       settings.JWT_SECRET, algorithm="HS256")
+    for name, middleware in (("BaseHTTPMiddleware", LegacyJWTAuthMiddleware), ("ASGI + token cache", JWTAuthMiddleware)):
+        app = build_app(middleware)
+        await run(app, token, 100)
+        per_request = await run(app, token, args.requests)
+        print(f"{name:<20} {per_request * 1e6:9.1f} us/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+# 1x1 PNG, the content does not matter unless IMAGE_NORMALIZE is on
+IMAGE = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+TERMINAL = ("COMPLETED", "FAILED")
+
+
+class FakeRunpodServer:
+    # a RunPod serverless endpoint: /run queues the job on `workers` GPUs and
+    # reports progress to the job's webhook, /status/{id} answers polling
+    def __init__(self, workers, queue_delay, gpu_time, failure_rate, bucket, rng):
+        self.workers = workers
+        self.queue_delay = queue_delay
+        self.gpu_time = gpu_time
+        self.failure_rate = failure_rate
+        self.bucket = bucket
+        self.rng = rng
+        self.jobs = {}
+        self.webhooks_failed = 0
+        self.loop = asyncio.new_event_loop()
+        self.url = None
+
+    async def run(self, request):
+        body = await request.json()
+        id = uuid.uuid4().hex
+        self.jobs[id] = {"status": "IN_QUEUE", "output": None}
+        asyncio.create_task(self.execute(id, body["input"]["image_key"], body.get("webhook"), time.monotonic()))
+        return web.json_response({"id": id, "status": "IN_QUEUE"})
+
+    async def status(self, request):
+        job = self.jobs.get(request.match_info["id"])
+        if job is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response({"id": request.match_info["id"], **job})
+
+    async def execute(self, id, image_key, webhook, queued):
+        await asyncio.sleep(self.queue_delay)
+        async with self.gpus:
+            started = time.monotonic()
+            self.jobs[id]["status"] = "IN_PROGRESS"
+            await self.notify(webhook, {"id": id, "status": "IN_PROGRESS"})
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.gpu_time)
+        job = self.jobs[id]
+        if self.rng.random() < self.failure_rate:
+            job["status"] = "FAILED"
+        else:
+            job["status"] = "COMPLETED"
+            job["output"] = {"message": f"https://{self.bucket}.s3.amazonaws.com/results/{image_key}.png"}
+        await self.notify(webhook, {"id": id, **job,
+                                    "delayTime": int((started - queued) * 1000),
+                                    "executionTime": int((time.monotonic() - started) * 1000)})
+
+    async def notify(self, webhook, payload):
+        if not webhook:
+            return
+        try:
+            async with self.session.post(webhook, json=payload) as response:
+                if response.status != 200:
+                    self.webhooks_failed += 1
+        except aiohttp.ClientError:
+            self.webhooks_failed += 1
+
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            self.gpus = asyncio.Semaphore(self.workers)
+            self.session = aiohttp.ClientSession()
+            app = web.Application()
+            app.router.add_post("/run", self.run)
+            app.router.add_get("/status/{id}", self.status)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+            ready.set()
+
+        threading.Thread(target=lambda: (self.loop.run_until_complete(serve()), self.loop.run_forever()),
+                         daemon=True).start()
+        ready.wait()
+
+
+def serve(port, runpod_url, fakes, env):
+    # runs in a spawned process so the API gets a core and an RSS of its own
+    os.environ.update({
+        "APP_BASE_URL": f"http://127.0.0.1:{port}",
+        "RUNPOD_URL": runpod_url,
+        "PUBSUB_BACKEND": "memory",
+        "METRICS_PUBLIC": "true",
+        **env,
+    })
+    import bench  # noqa: F401
+    from bench.fakes import install
+    install(runpod_url, **fakes)
+
+    import uvicorn
+    from api.app import app
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+class Recorder:
+    def __init__(self):
+        self.recording = False
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def add(self, op, seconds, status=None, error=False):
+        if not self.recording:
+            return
+        self.latencies.setdefault(op, []).append(seconds * 1000)
+        if status is not None:
+            counts = self.statuses.setdefault(op, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        if error:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def summary(self, elapsed):
+        result = {}
+        for op, values in sorted(self.latencies.items()):
+            values.sort()
+            result[op] = {
+                "count": len(values),
+                "errors": self.errors.get(op, 0),
+                "per_second": round(len(values) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50), 2),
+                "p90_ms": round(percentile(values, 90), 2),
+                "p99_ms": round(percentile(values, 99), 2),
+                "max_ms": round(values[-1], 2),
+                "statuses": self.statuses.get(op, {}),
+            }
+        return result
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+async def timed_request(recorder, op, session, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            recorder.add(op, time.perf_counter() - start, response.status, response.status >= 500)
+            return response, body
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        recorder.add(op, time.perf_counter() - start, "error", True)
+        return None, None
+
+
+async def follow_status(recorder, session, base, headers, job_id, poll_interval, deadline):
+    while time.monotonic() < deadline:
+        response, body = await timed_request(recorder, "status", session, "GET", f"{base}/status/{job_id}",
+                                             headers=headers, allow_redirects=False)
+        if response is not None and response.status == 200:
+            if body:
+                return "COMPLETED"
+            status = json.loads(response.headers.get("X-Image-Metadata", "{}")).get("status")
+            if status in TERMINAL:
+                return status
+        await asyncio.sleep(poll_interval)
+    return None
+
+
+async def follow_websocket(recorder, session, base, token, job_id, deadline):
+    start = time.perf_counter()
+    try:
+        async with session.ws_connect(f"{base}/ws/status", params={"id": job_id, "token": token}) as ws:
+            recorder.add("ws_connect", time.perf_counter() - start, 101)
+            while time.monotonic() < deadline:
+                message = await ws.receive(timeout=max(0.1, deadline - time.monotonic()))
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    return None
+                if message.data == "PING":
+                    await ws.send_str("PONG")
+                elif message.data in TERMINAL:
+                    return message.data
+    except aiohttp.WSServerHandshakeError as e:
+        # the job may already have finished, which closes the handshake with 1008
+        recorder.add("ws_connect", time.perf_counter() - start, e.status, e.status >= 500)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        recorder.add("ws_connect", time.perf_counter() - start, "error", True)
+    return None
+
+
+async def virtual_user(n, args, base, recorder, stop):
+    from jose import jwt
+    token = jwt.encode({"sub": f"bench-user-{n}", "aud": "authenticated", "exp": int(time.time()) + 86400},
+                       os.environ["JWT_SECRET"], algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}"}
+    # one generator per user, so a user's choices do not depend on how the
+    # others were scheduled
+    rng = random.Random(f"{args.seed}:{n}")
+    upload = IMAGE + rng.randbytes(max(0, args.upload_bytes - len(IMAGE)))
+    async with aiohttp.ClientSession() as session:
+        while not stop.is_set():
+            form = aiohttp.FormData()
+            form.add_field("image", upload, filename="input.png", content_type="image/png")
+            prompt = "a watercolor fox" if rng.random() < args.repeat_fraction else f"bench {rng.getrandbits(64):016x}"
+            form.add_field("prompt", prompt)
+            start = time.perf_counter()
+            response, body = await timed_request(recorder, "generate", session, "POST", f"{base}/generate",
+                                                 headers=headers, data=form)
+            if response is not None and response.status == 200:
+                job_id = json.loads(body)["job_id"]
+                deadline = time.monotonic() + args.job_timeout
+                if rng.random() < args.ws_fraction:
+                    outcome = await follow_websocket(recorder, session, base, token, job_id, deadline)
+                    if outcome is None:
+                        # fall back the way the frontend does
+                        outcome = await follow_status(recorder, session, base, headers, job_id,
+                                                      args.poll_interval, deadline)
+                else:
+                    outcome = await follow_status(recorder, session, base, headers, job_id,
+                                                  args.poll_interval, deadline)
+                recorder.add("job", time.perf_counter() - start, outcome or "timeout", outcome != "COMPLETED")
+            elif response is not None and response.status == 400:
+                # over MAX_ACTIVE_JOBS_PER_USER; back off like a client would
+                await asyncio.sleep(args.poll_interval)
+            if rng.random() < args.queues_fraction:
+                await timed_request(recorder, "queues", session, "GET", f"{base}/queues?limit=50", headers=headers)
+            if args.think:
+                await asyncio.sleep(rng.expovariate(1 / args.think))
+
+
+async def drive(args, base):
+    recorder = Recorder()
+    stop = asyncio.Event()
+    users = [asyncio.create_task(virtual_user(n, args, base, recorder, stop)) for n in range(args.users)]
+    await asyncio.sleep(args.warmup)
+    recorder.recording = True
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    recorder.recording = False
+    elapsed = time.perf_counter() - start
+    stop.set()
+    # users finish the job they are following; cut them off after job_timeout
+    await asyncio.wait(users, timeout=args.job_timeout)
+    for task in users:
+        task.cancel()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base}/metrics") as response:
+            metrics = await response.text()
+    return recorder, elapsed, metrics
+
+
+async def wait_ready(base, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline and process.is_alive():
+            try:
+                async with session.get(f"{base}/metrics") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise SystemExit("API server did not start")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"compared with {baseline_path} ({(baseline.get('commit') or '?')[:10]})")
+
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"{'requests/s':<12} {baseline['requests_per_second']:>9} -> {result['requests_per_second']:<9} "
+          f"{change(result['requests_per_second'], baseline['requests_per_second'])}")
+    print(f"{'peak RSS MB':<12} {baseline['server_peak_rss_mb']:>9} -> {result['server_peak_rss_mb']:<9} "
+          f"{change(result['server_peak_rss_mb'], baseline['server_peak_rss_mb'])}")
+    for name, op in result["operations"].items():
+        old = baseline["operations"].get(name)
+        if old:
+            print(f"{name:<12} p50 {change(op['p50_ms'], old['p50_ms']):>8}  p99 {change(op['p99_ms'], old['p99_ms']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API against in-process fakes of S3, SQS and Postgres "
+                                                 "and a fake RunPod endpoint that fires webhooks")
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--ws-fraction", type=float, default=0.5, help="share of jobs followed over the websocket")
+    parser.add_argument("--queues-fraction", type=float, default=0.3, help="chance of a /queues call after a job")
+    parser.add_argument("--repeat-fraction", type=float, default=0.0, help="share of identical submissions")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--think", type=float, default=0.5, help="mean seconds between a user's jobs")
+    parser.add_argument("--job-timeout", type=float, default=60)
+    parser.add_argument("--upload-bytes", type=int, default=512 * 1024)
+    parser.add_argument("--max-active-jobs", type=int, default=1, help="MAX_ACTIVE_JOBS_PER_USER for the server")
+    parser.add_argument("--db-latency", type=float, default=0.002)
+    parser.add_argument("--db-pool-size", type=int, default=10)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument("--s3-bandwidth", type=float, default=100e6, help="bytes per second")
+    parser.add_argument("--sqs-latency", type=float, default=0.01)
+    parser.add_argument("--result-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--gpu-workers", type=int, default=16)
+    parser.add_argument("--gpu-time", type=float, default=2.0, help="mean seconds of GPU time per job")
+    parser.add_argument("--runpod-queue-delay", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, help="seed for the simulated users and GPU times (default: random)")
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--compare", help="an earlier --output file to print the change against")
+    args = parser.parse_args()
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
+
+    import bench  # noqa: F401  (Settings defaults, also used to sign the tokens)
+    runpod = FakeRunpodServer(args.gpu_workers, args.runpod_queue_delay, args.gpu_time, args.failure_rate,
+                              os.environ["S3_BUCKET_NAME"], random.Random(args.seed))
+    runpod.start()
+
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    fakes = {"db_latency": args.db_latency, "db_pool_size": args.db_pool_size, "s3_latency": args.s3_latency,
+             "s3_bandwidth": args.s3_bandwidth, "result_bytes": args.result_bytes, "sqs_latency": args.sqs_latency}
+    env = {"MAX_ACTIVE_JOBS_PER_USER": str(args.max_active_jobs)}
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(port, runpod.url, fakes, env))
+    process.start()
+    try:
+        asyncio.run(wait_ready(base, process))
+        recorder, elapsed, metrics = asyncio.run(drive(args, base))
+    finally:
+        process.terminate()
+        process.join(30)
+
+    operations = recorder.summary(elapsed)
+    requests = sum(op["count"] for name, op in operations.items() if name != "job")
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "seed": args.seed,
+        "config": vars(args),
+        "elapsed_seconds": round(elapsed, 2),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 2),
+        "jobs_per_second": operations.get("job", {}).get("per_second", 0),
+        "operations": operations,
+        "server_peak_rss_mb": peak_rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN)),
+        "client_peak_rss_mb": peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF)),
+        "runpod_jobs": len(runpod.jobs),
+        "webhooks_failed": runpod.webhooks_failed,
+        "server_metrics": metrics,
+    }
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{requests} requests in {elapsed:.1f} s ({result['requests_per_second']} req/s), "
+          f"server peak RSS {result['server_peak_rss_mb']} MB")
+    print(f"{'operation':<12} {'count':>7} {'err':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+    for name, op in operations.items():
+        print(f"{name:<12} {op['count']:>7} {op['errors']:>5} {op['p50_ms']:>9} {op['p90_ms']:>9} {op['p99_ms']:>9}")
+    print(f"results written to {args.output} (seed {args.seed})")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
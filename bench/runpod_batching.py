@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+from bench.dispatch_latency import IMAGE, FakeDatabase, setup_aws
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import workflow  # noqa: E402
+from dispatcher import Dispatcher  # noqa: E402
+
+
+class FakeGpuRunpod:
+    # a RunPod endpoint with a fixed number of GPU workers; every request pays
+    # the warm-up once and then the per-image time for each job it carries
+    def __init__(self, workers, warmup, per_image):
+        self.workers = workers
+        self.warmup = warmup
+        self.per_image = per_image
+        self.requests = 0
+        self.gpu_seconds = 0.0
+        self.completed = {}
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        self.url = None
+
+    async def run(self, request):
+        body = json.loads(await request.read())
+        graph = body["input"]["workflow"]
+        for node_id, node in graph.items():
+            for value in node["inputs"].values():
+                if workflow.is_link(value) and value[0] not in graph:
+                    return web.json_response({"error": f"{node_id} links to missing {value[0]}"}, status=400)
+        if "webhook" in body:
+            keys = [body["webhook"].rsplit("/", 1)[-1]]
+        else:
+            keys = [node["inputs"]["filename_prefix"] for node in graph.values() if node["class_type"] == "SaveImage"]
+        self.requests += 1
+        await self.queue.put(keys)
+        return web.json_response({"id": uuid.uuid4().hex, "status": "IN_QUEUE"})
+
+    async def webhook(self, request):
+        return web.Response(status=200)
+
+    async def worker(self):
+        while True:
+            keys = await self.queue.get()
+            service = self.warmup + self.per_image * len(keys)
+            await asyncio.sleep(service)
+            self.gpu_seconds += service
+            now = time.perf_counter()
+            for key in keys:
+                self.completed[key] = now
+
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            self.queue = asyncio.Queue()
+            for _ in range(self.workers):
+                asyncio.create_task(self.worker())
+            app = web.Application(client_max_size=64 * 1024 * 1024)
+            app.router.add_post("/run", self.run)
+            app.router.add_post("/webhook/{key}", self.webhook)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+            ready.set()
+
+        threading.Thread(target=lambda: (self.loop.run_until_complete(serve()), self.loop.run_forever()),
+                         daemon=True).start()
+        ready.wait()
+
+
+def run_case(runpod, queue_url, jobs, batch_size, batch_window):
+    sqs = boto3.client("sqs")
+    s3 = boto3.client("s3")
+    keys = [str(uuid.uuid4()) for _ in range(jobs)]
+    for key in keys:
+        s3.put_object(Bucket=workflow.BUCKET_NAME, Key=key, Body=IMAGE)
+    db = FakeDatabase(0.001, lambda key: key in runpod.completed)
+    requests, gpu_seconds = runpod.requests, runpod.gpu_seconds
+
+    async def run():
+        dispatcher = Dispatcher(sqs, queue_url, db, concurrency=4 * jobs, wait_time=1,
+                                endpoint_concurrency=runpod.workers, slot_poll_interval=0.02,
+                                batch_size=batch_size, batch_window=batch_window)
+        task = asyncio.create_task(dispatcher.run())
+        start = time.perf_counter()
+        for i in range(0, jobs, 10):
+            entries = [{"Id": str(n), "MessageBody": json.dumps({
+                "image_key": key, "prompt": "a watercolor fox", "resolution": "512x512",
+                "webhook": f"{runpod.url}/webhook/{key}"})} for n, key in enumerate(keys[i:i + 10])]
+            await asyncio.to_thread(sqs.send_message_batch, QueueUrl=queue_url, Entries=entries)
+        while not all(key in runpod.completed for key in keys):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        dispatcher.stop()
+        await task
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    gpu = runpod.gpu_seconds - gpu_seconds
+    print(f"batch {batch_size:<3} {jobs} jobs in {elapsed:6.2f} s  {jobs / elapsed:6.1f} jobs/s  "
+          f"{runpod.requests - requests:4d} RunPod requests  {jobs / gpu:5.2f} jobs per GPU-second")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPU throughput with and without micro-batched RunPod requests")
+    parser.add_argument("--jobs", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=2, help="GPU workers behind the fake endpoint")
+    parser.add_argument("--warmup", type=float, default=0.4, help="seconds of model load/warm-up per request")
+    parser.add_argument("--per-image", type=float, default=0.1)
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    parser.add_argument("--batch-window", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with mock_aws():
+        runpod = FakeGpuRunpod(args.workers, args.warmup, args.per_image)
+        runpod.start()
+        setup_aws(runpod.url)
+        for batch_size in (int(size) for size in args.batch_sizes.split(",")):
+            queue_url = boto3.client("sqs").create_queue(QueueName=f"batch-{uuid.uuid4().hex[:8]}")["QueueUrl"]
+            run_case(runpod, queue_url, args.jobs, batch_size, args.batch_window)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+
+import workflow  # noqa: E402
+
+
+def legacy_build(message_data):
+    # the per-job body build this benchmark compares against: re-open, re-parse and mutate
+    with open(os.path.join(workflow.WORKFLOWS_DIR, "img2img_flux.json")) as f:
+        template = json.load(f)
+    template["6"]["inputs"]["text"] = message_data["prompt"]
+    template["82"] = {"inputs": {"image": "x.png"}, "class_type": "LoadImage", "_meta": {"title": "Load Image"}}
+    return {"webhook": message_data["webhook"], "input": {"images": [{"name": "x.png", "image": "..."}], "workflow": template}}
+
+
+def measure(fn, message_data, jobs):
+    start = time.perf_counter()
+    for _ in range(jobs):
+        fn(message_data)
+    return (time.perf_counter() - start) / jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-job RunPod request body build time")
+    parser.add_argument("--jobs", type=int, default=20000)
+    args = parser.parse_args()
+
+    # keep S3 out of the measurement
+    workflow.load_image = lambda image_key: "..."
+    message_data = {"image_key": "key", "prompt": "a watercolor fox", "webhook": "http://localhost/webhook/key"}
+    for name, fn in (("json.load per job", legacy_build), ("compiled registry", workflow.build_request_body)):
+        fn(message_data)
+        print(f"{name:<18} {measure(fn, message_data, args.jobs) * 1e6:8.1f} us/job")
+
+
+if __name__ == "__main__":
+    main()
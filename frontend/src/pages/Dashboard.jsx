@@ -7,6 +7,8 @@ import { useApi } from '../services/Api';
 export default function Dashboard() {
   const [loading, setLoading] = useState(false);
   const [queues, setQueues] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const {getQueues, getStatus, subscribeToQueueStatus} = useApi();
   const [selectedStatus, setSelectedStatus] = useState(null);
   const [selectedImage, setSelectedImage] = useState(null);
@@ -16,8 +18,9 @@ export default function Dashboard() {
   useEffect(() => {
     const fetchQueues = async () => {
       try {
-        const data = await getQueues();
-        setQueues(data);
+        const { items, nextCursor } = await getQueues();
+        setQueues(items);
+        setNextCursor(nextCursor);
       } catch {
         alert('Error fetching queues');
       }
@@ -50,6 +53,19 @@ export default function Dashboard() {
   
   
 
+  const handleLoadMore = async () => {
+    setLoadingMore(true);
+    try {
+      const { items, nextCursor: cursor } = await getQueues(nextCursor);
+      setQueues((prev) => [...prev, ...items]);
+      setNextCursor(cursor);
+    } catch {
+      alert('Error fetching queues');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleQueueClick = async (jobId) => {
     setLoading(true);
     try {
@@ -90,8 +106,8 @@ export default function Dashboard() {
               <p className="text-gray-500 dark:text-gray-400">No queues available</p>
             ) : (
               <ul className="space-y-4">
-                {queues.map((queue, index) => (
-                  <li key={index} className="bg-gray-100 dark:bg-gray-700 p-4 rounded">
+                {queues.map((queue) => (
+                  <li key={queue.s3_object_id} className="bg-gray-100 dark:bg-gray-700 p-4 rounded">
                     <p>
                       <span className="font-semibold text-gray-700 dark:text-gray-200">
                         ID:
@@ -111,6 +127,15 @@ export default function Dashboard() {
                 ))}
               </ul>
             )}
+            {nextCursor && (
+              <button
+                onClick={handleLoadMore}
+                disabled={loadingMore}
+                className="mt-4 bg-gray-700 text-white px-4 py-2 rounded hover:bg-gray-800"
+              >
+                {loadingMore ? 'Loading...' : 'Load more'}
+              </button>
+            )}
           </div>     
           {modalVisible && (
             <div className="fixed inset-0 bg-black bg-opacity-50 flex justify-center items-center z-50">
@@ -16,8 +16,10 @@ export function useApi() {
     });
   }, [accessToken]);
 
-  const getQueues = useCallback(async () => {
-    const res = await fetch(`${API_BASE_URL}/queues`, {
+  // one page of the user's queues, newest first; nextCursor is null on the last page
+  const getQueues = useCallback(async (before = null) => {
+    const query = before ? `?before=${encodeURIComponent(before)}` : '';
+    const res = await fetch(`${API_BASE_URL}/queues${query}`, {
       method: 'GET',
       headers: {
         ...(accessToken && { Authorization: `Bearer ${accessToken}` }),
@@ -25,10 +27,10 @@ export function useApi() {
     });
 
     if (res.ok) {
-      return await res.json();
+      return { items: await res.json(), nextCursor: res.headers.get('X-Next-Cursor') };
     } else {
       console.error('Failed to fetch queues:', res.statusText);
-      return [];
+      return { items: [], nextCursor: null };
     }
   }, [accessToken]);
 
@@ -41,7 +43,8 @@ export function useApi() {
     });
   
     const metadata = res.headers.get("X-Image-Metadata");
-    const status = metadata ? JSON.parse(metadata).status : "UNKNOWN";
+    // a redirect to the presigned result URL only happens for completed jobs
+    const status = metadata ? JSON.parse(metadata).status : (res.redirected ? "COMPLETED" : "UNKNOWN");
   
     if (res.ok) {
       const contentType = res.headers.get("Content-Type");
@@ -63,6 +66,10 @@ export function useApi() {
   
     ws.onmessage = (event) => {
       const status = event.data;
+      if (status === 'PING') {
+        ws.send('PONG');
+        return;
+      }
       onMessage(status);
   
       if (status === 'COMPLETED' || status === 'FAILED') {
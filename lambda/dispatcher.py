@@ -0,0 +1,509 @@
+# Long-running alternative to the Lambda: polls SQS itself and keeps the HTTP
+# pool, DB connection and secrets warm across messages.
+#
+#   cd lambda && SQS_QUEUE_URL=... python -m dispatcher
+#
+# Local stand-ins are picked up through boto3's AWS_ENDPOINT_URL_SQS /
+# AWS_ENDPOINT_URL_S3 and, when RUNPOD_API_URL is set, RunPod and the DB are
+# configured from the environment instead of Secrets Manager.
+import asyncio
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import boto3
+
+from lambda_function import (Database, get_finished_jobs, job_event, load_secrets, parse_message, record_job_events,
+                             runpod_queue_status, update_queue_statuses)
+from log import logger
+from scheduler import FairScheduler, SchedulerClosed
+from workflow import DEFAULT_WORKFLOW, build_batch_request_body, build_request_body, encode_body
+
+QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
+CONCURRENCY = int(os.environ.get("DISPATCH_CONCURRENCY", "32"))
+POLLERS = int(os.environ.get("SQS_POLLERS", "2"))
+WAIT_TIME = int(os.environ.get("SQS_WAIT_TIME", "20"))
+VISIBILITY_TIMEOUT = int(os.environ.get("SQS_VISIBILITY_TIMEOUT", "60"))
+# a message that should be retried becomes visible again after this long
+RETRY_DELAY = int(os.environ.get("RETRY_DELAY", "10"))
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "50"))
+DB_BATCH_WAIT = float(os.environ.get("DB_BATCH_WAIT", "0.02"))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "30"))
+RUNPOD_TIMEOUT = float(os.environ.get("RUNPOD_TIMEOUT", "30"))
+# GPU jobs allowed in flight per RunPod endpoint; DISPATCH_CONCURRENCY should be
+# larger so the scheduler has waiting jobs to choose from
+ENDPOINT_CONCURRENCY = int(os.environ.get("ENDPOINT_CONCURRENCY", "8"))
+TIER_WEIGHTS = json.loads(os.environ.get("TIER_WEIGHTS", "{}"))
+# a slot is freed once the job is COMPLETED/FAILED in the DB, or after SLOT_TIMEOUT
+SLOT_POLL_INTERVAL = float(os.environ.get("SLOT_POLL_INTERVAL", "2"))
+SLOT_TIMEOUT = float(os.environ.get("SLOT_TIMEOUT", "1800"))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", "30"))
+# up to BATCH_SIZE jobs with the same workflow and resolution go to RunPod as one
+# request; the job that gets the slot waits BATCH_WINDOW for others to join
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "1"))
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", "0.05"))
+# batching needs a worker that returns every saved image URL as a list in
+# output.message, and the API's reconciler: batched requests have no webhook
+BATCH_WORKER_OUTPUT = os.environ.get("BATCH_WORKER_OUTPUT", "single")
+
+SQS_MAX_BATCH = 10
+
+def env_secrets(force=False):
+    return {
+        "runpod": {
+            "api_url": os.environ["RUNPOD_API_URL"],
+            "api_token": os.environ.get("RUNPOD_API_TOKEN", ""),
+        },
+        "postgres": {
+            name: os.environ.get(name, "")
+            for name in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_PORT", "DB_SCHEMA")
+        },
+    }
+
+def secrets_provider():
+    return env_secrets if os.environ.get("RUNPOD_API_URL") else load_secrets
+
+class Batcher:
+    # collects items from many tasks and flushes them together, either when
+    # max_size is reached or max_wait after the first item arrived
+    def __init__(self, flush, max_size, max_wait):
+        self.flush_fn = flush
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.timer = None
+        self.flushes = set()
+
+    async def add(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            await self.flush_fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def close(self):
+        self.flush()
+        while self.flushes:
+            await asyncio.gather(*list(self.flushes), return_exceptions=True)
+
+class Dispatcher:
+    def __init__(self, sqs, queue_url, db, secrets=None, concurrency=CONCURRENCY, pollers=POLLERS,
+                 wait_time=WAIT_TIME, visibility_timeout=VISIBILITY_TIMEOUT, retry_delay=RETRY_DELAY,
+                 db_batch_size=DB_BATCH_SIZE, db_batch_wait=DB_BATCH_WAIT,
+                 endpoint_concurrency=ENDPOINT_CONCURRENCY, tier_weights=None, slot_poll_interval=SLOT_POLL_INTERVAL,
+                 batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.db = db
+        self.secrets = secrets or secrets_provider()
+        self.concurrency = concurrency
+        self.pollers = pollers
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.retry_delay = retry_delay
+        # boto3, psycopg2 and S3 body reads are blocking
+        self.executor = ThreadPoolExecutor(max_workers=concurrency + pollers + 4, thread_name_prefix="dispatch")
+        self.db_writer = Batcher(self._write_statuses, db_batch_size, db_batch_wait)
+        self.event_writer = Batcher(self._write_events, db_batch_size, db_batch_wait)
+        self.deleter = Batcher(self._delete_messages, SQS_MAX_BATCH, db_batch_wait)
+        self.session = None
+        self.stopping = asyncio.Event()
+        self.tasks = set()
+        self.reserved = 0
+        self.slot_freed = asyncio.Event()
+        # receipt handle -> time the message becomes visible again
+        self.deadlines = {}
+        self.endpoint_concurrency = endpoint_concurrency
+        self.tier_weights = TIER_WEIGHTS if tier_weights is None else tier_weights
+        self.slot_poll_interval = slot_poll_interval
+        # RunPod endpoint URL -> scheduler
+        self.schedulers = {}
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        # (endpoint, group) -> jobs of a batch still accepting riders
+        self.open_batches = {}
+        # rider image_key -> future resolved by the batch leader
+        self.batch_results = {}
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def stop(self):
+        logger.info("Dispatcher stopping")
+        self.stopping.set()
+        self.slot_freed.set()
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+
+    def scheduler_for(self, endpoint):
+        scheduler = self.schedulers.get(endpoint)
+        if scheduler is None:
+            scheduler = FairScheduler(self.endpoint_concurrency, self.tier_weights)
+            self.schedulers[endpoint] = scheduler
+        return scheduler
+
+    async def run(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=RUNPOD_TIMEOUT),
+        )
+        try:
+            background = [
+                asyncio.create_task(self._extend_visibility()),
+                asyncio.create_task(self._track_slots()),
+                asyncio.create_task(self._log_stats()),
+            ]
+            await asyncio.gather(*(self._poll() for _ in range(self.pollers)))
+            await self._drain()
+            for task in background:
+                task.cancel()
+            await self.db_writer.close()
+            await self.event_writer.close()
+            await self.deleter.close()
+        finally:
+            await self.session.close()
+            self.executor.shutdown(wait=False)
+
+    async def _poll(self):
+        while not self.stopping.is_set():
+            free = self.concurrency - len(self.tasks) - self.reserved
+            if free <= 0:
+                self.slot_freed.clear()
+                await self.slot_freed.wait()
+                continue
+            count = min(SQS_MAX_BATCH, free)
+            self.reserved += count
+            try:
+                messages = await self._receive(count)
+            except Exception as e:
+                logger.error(f"SQS receive failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            finally:
+                self.reserved -= count
+
+            if self.stopping.is_set():
+                # received during shutdown, hand them straight back
+                await self._release([m["ReceiptHandle"] for m in messages], 0)
+                break
+            deadline = time.monotonic() + self.visibility_timeout
+            for message in messages:
+                self.deadlines[message["ReceiptHandle"]] = deadline
+                task = asyncio.create_task(self._handle(message))
+                self.tasks.add(task)
+                task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        self.slot_freed.set()
+
+    async def _receive(self, count):
+        response = await self._run(lambda: self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=count,
+            WaitTimeSeconds=self.wait_time,
+            VisibilityTimeout=self.visibility_timeout,
+        ))
+        return response.get("Messages", [])
+
+    async def _drain(self):
+        if not self.tasks:
+            return
+        logger.info(f"Waiting for {len(self.tasks)} in-flight messages")
+        done, pending = await asyncio.wait(set(self.tasks), timeout=SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _extend_visibility(self):
+        # messages still being worked on are kept invisible so SQS does not
+        # hand them to another consumer while RunPod is slow to answer
+        interval = max(self.visibility_timeout / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            due = [handle for handle, deadline in self.deadlines.items() if deadline - now < self.visibility_timeout / 2]
+            for i in range(0, len(due), SQS_MAX_BATCH):
+                batch = due[i:i + SQS_MAX_BATCH]
+                try:
+                    await self._release(batch, self.visibility_timeout)
+                except Exception as e:
+                    logger.error(f"SQS visibility extension failed: {e}")
+                    continue
+                for handle in batch:
+                    if handle in self.deadlines:
+                        self.deadlines[handle] = now + self.visibility_timeout
+
+    async def _track_slots(self):
+        while True:
+            await asyncio.sleep(self.slot_poll_interval)
+            for endpoint, scheduler in self.schedulers.items():
+                if not scheduler.in_flight:
+                    continue
+                try:
+                    finished = await self._run(get_finished_jobs, self.db, scheduler.jobs())
+                except Exception as e:
+                    logger.error(f"Slot check failed: {e}")
+                    continue
+                for key in finished:
+                    scheduler.release(key)
+                for slot in scheduler.expired(SLOT_TIMEOUT):
+                    logger.error(f"Job {slot} held a slot on {endpoint} for {SLOT_TIMEOUT}s, releasing")
+                    scheduler.release_slot(slot)
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            for endpoint, scheduler in self.schedulers.items():
+                logger.info(json.dumps({"endpoint": endpoint, **scheduler.stats()}))
+
+    async def _release(self, handles, timeout):
+        if not handles:
+            return
+        entries = [{"Id": str(i), "ReceiptHandle": handle, "VisibilityTimeout": timeout}
+                   for i, handle in enumerate(handles)]
+        await self._run(lambda: self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries))
+
+    async def _delete_messages(self, handles):
+        entries = [{"Id": str(i), "ReceiptHandle": handle} for i, handle in enumerate(handles)]
+        response = await self._run(lambda: self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries))
+        for failed in response.get("Failed", []):
+            logger.error(f"SQS delete failed: {failed.get('Code')} {failed.get('Message')}")
+
+    async def _write_statuses(self, updates):
+        await self._run(update_queue_statuses, self.db, updates)
+
+    async def _write_events(self, batches):
+        await self._run(record_job_events, self.db, [event for events in batches for event in events])
+
+    async def _handle(self, message):
+        handle = message["ReceiptHandle"]
+        try:
+            ok = await self.process_message(message)
+        except asyncio.CancelledError:
+            ok = False
+        except Exception as e:
+            logger.error(f"Unhandled error for message {message.get('MessageId')}: {e}")
+            ok = False
+        self.deadlines.pop(handle, None)
+        try:
+            if ok:
+                await self.deleter.add(handle)
+            else:
+                await self._release([handle], 0 if self.stopping.is_set() else self.retry_delay)
+        except Exception as e:
+            logger.error(f"SQS ack failed for message {message.get('MessageId')}: {e}")
+
+    # same outcomes as lambda_function.process_record: False means redeliver
+    async def process_message(self, message):
+        message_data = parse_message(message.get("Body") or "")
+        if not message_data:
+            return True
+
+        image_key = message_data.get("image_key")
+        if not image_key:
+            logger.error(f"Missing image_key in message {message.get('MessageId')}")
+            return True
+        received = job_event(message_data, "dispatch.received")
+
+        secrets = await self._run(self.secrets)
+        endpoint = secrets["runpod"]["api_url"]
+        scheduler = self.scheduler_for(endpoint)
+        group = (message_data.get("workflow_name") or DEFAULT_WORKFLOW, message_data.get("resolution"))
+        batch = self.open_batches.get((endpoint, group)) if self.batch_size > 1 else None
+        if batch is not None and len(batch) < self.batch_size:
+            # rides along with a batch that is still collecting; no slot of its own
+            scheduler.attach(image_key, batch[0][0])
+            slot = batch[0][0]
+            batch.append((image_key, message_data))
+            self.batch_results[image_key] = asyncio.get_running_loop().create_future()
+        else:
+            try:
+                slot = await scheduler.acquire(image_key, message_data.get("userid") or image_key,
+                                               message_data.get("tier"), group=group, data=message_data)
+            except SchedulerClosed:
+                return False
+        slotted = job_event(message_data, "dispatch.slot")
+
+        if slot is None:
+            results = await self.lead_batch(scheduler, endpoint, group, image_key, message_data, secrets)
+            result = results[image_key]
+        else:
+            result = await self.batch_results[image_key]
+        submitted, ok, status_to_update, runpod_id = result
+        if not submitted:
+            scheduler.release(image_key)
+        if status_to_update is None:
+            return ok
+
+        try:
+            writes = [self.db_writer.add((image_key, status_to_update, runpod_id, None))]
+            if submitted:
+                writes.append(self.event_writer.add([received, slotted, job_event(message_data, "runpod.submitted")]))
+            await asyncio.gather(*writes)
+            webhook_url = message_data.get("webhook")
+            if webhook_url:
+                await self.post_webhook(webhook_url, status_to_update)
+        except Exception as db_err:
+            # RunPod already accepted the job, a redelivery would run it twice
+            logger.error(f"Final status update failed: {db_err}")
+        return True
+
+    async def lead_batch(self, scheduler, endpoint, group, image_key, message_data, secrets):
+        # the job holding the slot sends the request, taking compatible jobs that
+        # are waiting for a slot and, for batch_window, jobs that arrive meanwhile
+        jobs = [(image_key, message_data)]
+        if self.batch_size > 1:
+            jobs += self._take(scheduler, image_key, group, self.batch_size - 1)
+            # one batch per group collects at a time, other leaders go as they are
+            if len(jobs) < self.batch_size and self.batch_window > 0 and (endpoint, group) not in self.open_batches:
+                self.open_batches[(endpoint, group)] = jobs
+                try:
+                    await asyncio.sleep(self.batch_window)
+                finally:
+                    del self.open_batches[(endpoint, group)]
+                jobs += self._take(scheduler, image_key, group, self.batch_size - len(jobs))
+        results = {}
+        try:
+            results = await self.submit(jobs, secrets)
+        finally:
+            for key, _ in jobs[1:]:
+                future = self.batch_results.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(results.get(key, (False, False, None, None)))
+        return results
+
+    def _take(self, scheduler, slot, group, limit):
+        taken = scheduler.take(slot, group, limit)
+        for key, _ in taken:
+            self.batch_results[key] = asyncio.get_running_loop().create_future()
+        return taken
+
+    async def _build(self, jobs, results):
+        built = []
+        for image_key, message_data in jobs:
+            try:
+                built.append((image_key, await self._run(build_request_body, message_data)))
+            except Exception as e:
+                logger.error(f"Failed to build request body for {image_key}: {e}")
+                results[image_key] = (False, True, "FAILED", None)
+        return built
+
+    # maps each image_key to (submitted, ok, status, runpod_id); status is None
+    # when there is nothing to record
+    async def submit(self, jobs, secrets):
+        results = {}
+        built = await self._build(jobs, results)
+        if not built:
+            return results
+        keys = [image_key for image_key, _ in built]
+        if len(built) > 1:
+            logger.info(f"Submitting batch of {len(built)} jobs: {keys}")
+
+        try:
+            status_code, status_to_update, runpod_id = await self.post_runpod(
+                secrets["runpod"]["api_url"], secrets["runpod"]["api_token"], build_batch_request_body(built)
+            )
+            if status_code in (401, 403):
+                logger.info("RunPod rejected the token, refreshing secrets")
+                secrets = await self._run(self.secrets, True)
+                # streamed images are consumed by the first attempt
+                built = await self._build([job for job in jobs if job[0] in keys], results)
+                keys = [image_key for image_key, _ in built]
+                status_code, status_to_update, runpod_id = await self.post_runpod(
+                    secrets["runpod"]["api_url"], secrets["runpod"]["api_token"], build_batch_request_body(built)
+                )
+        except Exception as e:
+            logger.error(f"Error during POST request for {keys}: {e}")
+            return {**results, **{key: (False, False, None, None) for key in keys}}
+        if status_code == 429 or status_code >= 500:
+            logger.error(f"RunPod rejected {keys} with status {status_code}, retrying")
+            return {**results, **{key: (False, False, None, None) for key in keys}}
+
+        submitted = status_code < 300 and runpod_id is not None
+        for i, key in enumerate(keys):
+            # "<request id>#<n>" tells the reconciler this job's result is one of several
+            job_runpod_id = f"{runpod_id}#{i}" if runpod_id and len(keys) > 1 else runpod_id
+            results[key] = (submitted, True, status_to_update, job_runpod_id)
+        return results
+
+    async def post_runpod(self, url, token, payload):
+        body, chunked = encode_body(payload)
+        if chunked:
+            body = self._stream(body)
+        async with self.session.post(
+            url,
+            data=body,
+            headers={"Content-Type": "application/json", "Authorization": token},
+        ) as response:
+            logger.info(f"Response status: {response.status}")
+            return (response.status, *runpod_queue_status(response.status, await response.read()))
+
+    async def _stream(self, chunks):
+        # each chunk is read from S3 and base64-encoded off the event loop
+        while True:
+            chunk = await self._run(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def post_webhook(self, url, status):
+        try:
+            async with self.session.post(url, json={"status": status}) as response:
+                logger.info(f"webhook Response status: {response.status}")
+        except Exception as e:
+            logger.error(f"Error during POST webhook: {e}")
+
+async def main():
+    if not QUEUE_URL:
+        raise SystemExit("SQS_QUEUE_URL is required")
+    if BATCH_SIZE > 1 and BATCH_WORKER_OUTPUT != "list":
+        raise SystemExit("BATCH_SIZE > 1 needs a RunPod worker that returns a list of image URLs in "
+                         "output.message; set BATCH_WORKER_OUTPUT=list once it does, and keep "
+                         "RECONCILER_ENABLED on the API since batched requests get no webhook")
+    secrets = secrets_provider()
+    db = Database(lambda force=False: secrets(force)["postgres"])
+    dispatcher = Dispatcher(boto3.client("sqs"), QUEUE_URL, db, secrets)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, dispatcher.stop)
+    logger.info(f"Dispatcher polling {QUEUE_URL} with concurrency {dispatcher.concurrency}")
+    try:
+        await dispatcher.run()
+    finally:
+        db.close()
+    logger.info("Dispatcher stopped")
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())
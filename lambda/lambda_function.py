@@ -1,29 +1,41 @@
+import time
+_INIT_STARTED = time.monotonic()
+
 import json
 import boto3
 import urllib3
 import os
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from workflow import build_request_body
+from psycopg2.extras import RealDictCursor, execute_values
+from workflow import build_request_body, encode_body
 from log import logger
 
 # Clients
 secrets_client = boto3.client("secretsmanager")
 s3_client = boto3.client("s3")
-http = urllib3.PoolManager()
 
 # Load bucket name from environment variable
 BUCKET_NAME = os.environ.get("S3_BUCKET_NAME", "satria-bucket")
+# records of one SQS batch are dispatched concurrently by this many threads
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))
+# secrets and the DB connection survive warm invocations of this container
+SECRETS_TTL = float(os.environ.get("SECRETS_TTL", "300"))
+DB_HEALTHCHECK_AFTER = float(os.environ.get("DB_HEALTHCHECK_AFTER", "30"))
+
+http = urllib3.PoolManager(maxsize=MAX_WORKERS)
 
 def get_secrets(secret_name, region_name="us-east-1"):
     response = secrets_client.get_secret_value(SecretId=secret_name)
     return json.loads(response["SecretString"])
 
-def extract_message(event):
+def extract_records(event):
     if "Records" in event:
-        return event["Records"][0].get("body")
+        return event["Records"]
     logger.error("No 'Records' found in the event")
-    return None
+    return []
 
 def parse_message(message):
     try:
@@ -32,36 +44,65 @@ def parse_message(message):
         logger.error(f"Error decoding JSON message: {e}")
         return None
 
-def load_secrets():
+_secrets = None
+_secrets_loaded_at = 0.0
+_secrets_lock = threading.Lock()
+
+def load_secrets(force=False):
+    global _secrets, _secrets_loaded_at
+    with _secrets_lock:
+        if not force and _secrets and time.monotonic() - _secrets_loaded_at < SECRETS_TTL:
+            return _secrets
+        try:
+            runpod_secrets = get_secrets("runpod")
+            postgres_secrets = get_secrets("postgres")
+            logger.info("Secrets loaded successfully")
+            _secrets = {
+                "runpod": runpod_secrets,
+                "postgres": postgres_secrets
+            }
+            _secrets_loaded_at = time.monotonic()
+            return _secrets
+        except Exception as e:
+            logger.error(f"Failed to load secrets: {e}")
+            raise
+
+# the statuses queue.status may hold (TaskStatus in api/db/postgres.py)
+RUNPOD_STATUSES = ("IN_QUEUE", "IN_PROGRESS", "COMPLETED", "FAILED")
+
+def runpod_queue_status(http_status, body):
+    # what a /run response means for queue.status: a rejected request, an
+    # unreadable body or a status the API does not know fails the job
     try:
-        runpod_secrets = get_secrets("runpod")
-        postgres_secrets = get_secrets("postgres")
-        logger.info("Secrets loaded successfully")
-        return {
-            "runpod": runpod_secrets,
-            "postgres": postgres_secrets
-        }
-    except Exception as e:
-        logger.error(f"Failed to load secrets: {e}")
-        raise
+        response_json = json.loads(body)
+    except ValueError:
+        response_json = None
+    if not isinstance(response_json, dict):
+        return "FAILED", None
+    status = response_json.get("status")
+    if http_status >= 300 or status not in RUNPOD_STATUSES:
+        return "FAILED", response_json.get("id")
+    return status, response_json.get("id")
 
 def send_post_request_runpod(url, token, payload):
     try:
         logger.info("Making POST request to the API")
+        body, chunked = encode_body(payload)
         response = http.request(
             "POST",
             url,
-            body=json.dumps(payload),
+            body=body,
             headers={
                 "Content-Type": "application/json",
                 "Authorization": token
-            }
+            },
+            chunked=chunked,
+            # a streamed body cannot be replayed; SQS redelivery retries instead
+            retries=False if chunked else None
         )
         logger.info(f"Response status: {response.status}")
 
-        response_json = json.loads(response.data.decode("utf-8"))
-        status = response_json.get("status", "ERROR")
-        runpod_id = response_json.get("id")
+        status, runpod_id = runpod_queue_status(response.status, response.data)
 
         return response, status, runpod_id
 
@@ -88,16 +129,30 @@ def send_post_request_webhook(url, status):
         logger.error(f"Error during POST webhook: {e}")
     
 
-def update_queue_status(db_config, s3_object_id, status,runpod_id=None, image_result=None):
-    query = """
-        UPDATE queue
-        SET status = %s,
-            runpod_id = COALESCE(%s, runpod_id),
-            image_result = COALESCE(%s, image_result),
-            updated_on = now()
-        WHERE s3_object_id = %s
-    """
-    try:
+def is_auth_error(error):
+    return "password authentication failed" in str(error)
+
+class Database:
+    # one psycopg2 connection shared by the worker threads and kept across
+    # warm invocations; it is pinged after being idle and rebuilt on error
+    def __init__(self, config_provider):
+        self.config_provider = config_provider
+        self.conn = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        db_config = self.config_provider()
+        try:
+            return self._connect(db_config)
+        except psycopg2.OperationalError as e:
+            if not is_auth_error(e):
+                raise
+            logger.info("DB authentication failed, refreshing secrets")
+            return self._connect(self.config_provider(force=True))
+
+    def _connect(self, db_config):
+        started = time.monotonic()
         conn = psycopg2.connect(
             user=db_config["DB_USER"],
             password=db_config["DB_PASSWORD"],
@@ -106,77 +161,222 @@ def update_queue_status(db_config, s3_object_id, status,runpod_id=None, image_re
             database=db_config["DB_SCHEMA"],
             connect_timeout=5
         )
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(query, (status, runpod_id, image_result, s3_object_id))
-                logger.info(f"Updated DB for {s3_object_id} with status {status}")
+        logger.info(f"DB connected in {(time.monotonic() - started) * 1000:.1f}ms")
+        return conn
+
+    def _healthy(self):
+        if self.conn is None or self.conn.closed:
+            return False
+        if time.monotonic() - self.last_used < DB_HEALTHCHECK_AFTER:
+            return True
+        try:
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def execute(self, query, params):
+        self._run(lambda cur: cur.execute(query, params))
+
+    def execute_values(self, query, rows):
+        self._run(lambda cur: execute_values(cur, query, rows))
+
+    def fetch(self, query, params):
+        rows = []
+        def statement(cur):
+            cur.execute(query, params)
+            rows[:] = cur.fetchall()
+        self._run(statement)
+        return rows
+
+    def _run(self, statement):
+        with self.lock:
+            for attempt in range(2):
+                if not self._healthy():
+                    self.close()
+                    self.conn = self.connect()
+                try:
+                    with self.conn:
+                        with self.conn.cursor() as cur:
+                            statement(cur)
+                    self.last_used = time.monotonic()
+                    return
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self.close()
+                    if attempt:
+                        raise
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+_db = Database(lambda force=False: load_secrets(force)["postgres"])
+_cold_start = True
+
+# statuses only move forward, as in api/db/postgres.py: a late IN_QUEUE write
+# never undoes a COMPLETED or FAILED from the webhook or the reconciler. The
+# runpod_id is still stored, the reconciler needs it to poll the job.
+STATUS_RANK_SQL = ("CASE {} WHEN 'NEW' THEN 0 WHEN 'IN_QUEUE' THEN 1 WHEN 'IN_PROGRESS' THEN 2 "
+                   "WHEN 'COMPLETED' THEN 3 WHEN 'FAILED' THEN 3 END")
+
+def update_queue_status(db, s3_object_id, status,runpod_id=None, image_result=None):
+    query = f"""
+        UPDATE queue
+        SET status = CASE WHEN {STATUS_RANK_SQL.format("status")} < {STATUS_RANK_SQL.format("%(status)s")}
+                          THEN %(status)s ELSE status END,
+            runpod_id = COALESCE(%(runpod_id)s, runpod_id),
+            image_result = COALESCE(%(image_result)s, image_result),
+            updated_on = now()
+        WHERE s3_object_id = %(s3_object_id)s
+    """
+    try:
+        db.execute(query, {"status": status, "runpod_id": runpod_id, "image_result": image_result,
+                           "s3_object_id": s3_object_id})
+        logger.info(f"Updated DB for {s3_object_id} with status {status}")
     except Exception as e:
         logger.error(f"Database update failed: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def lambda_handler(event, context):
-    logger.info(f"Received event: {json.dumps(event)}")
-    status_to_update = "ERROR"
-    image_key = None  # Define early for use in `finally`
+def update_queue_statuses(db, updates):
+    # updates are (s3_object_id, status, runpod_id, image_result); one statement for all
+    latest = {update[0]: update for update in updates}
+    query = f"""
+        UPDATE queue AS q
+        SET status = CASE WHEN {STATUS_RANK_SQL.format("q.status")} < {STATUS_RANK_SQL.format("v.status")}
+                          THEN v.status ELSE q.status END,
+            runpod_id = COALESCE(v.runpod_id, q.runpod_id),
+            image_result = COALESCE(v.image_result, q.image_result),
+            updated_on = now()
+        FROM (VALUES %s) AS v(s3_object_id, status, runpod_id, image_result)
+        WHERE q.s3_object_id = v.s3_object_id
+    """
+    try:
+        db.execute_values(query, list(latest.values()))
+        logger.info(f"Updated DB for {len(latest)} jobs")
+    except Exception as e:
+        logger.error(f"Database batch update failed: {e}")
+        raise
+
+def get_finished_jobs(db, s3_object_ids):
+    query = """
+        SELECT s3_object_id FROM queue
+        WHERE s3_object_id = ANY(%s) AND status IN ('COMPLETED', 'FAILED')
+    """
+    return [row[0] for row in db.fetch(query, (list(s3_object_ids),))]
+
+def job_event(message_data, event):
+    return (message_data["image_key"], message_data.get("trace_id"), event, datetime.now(timezone.utc))
 
+def record_job_events(db, events):
+    # timeline rows (s3_object_id, trace_id, event, at); losing them never fails a job
+    if not events:
+        return
+    query = "INSERT INTO job_events (s3_object_id, trace_id, event, at) VALUES %s"
     try:
-        message = extract_message(event)
-        if not message:
-            return {"statusCode": 400, "body": "No 'Records' found in the event"}
+        db.execute_values(query, events)
+    except Exception as e:
+        logger.error(f"Recording {len(events)} job events failed: {e}")
 
-        message_data = parse_message(message)
-        if not message_data:
-            return {"statusCode": 400, "body": "Invalid message format"}
+# returns False when the message should be redelivered by SQS; timeline events
+# are appended to events when a list is given
+def process_record(record, secrets, db, events=None):
+    message_data = parse_message(record.get("body") or "")
+    if not message_data:
+        return True
 
-        #image_key are mandatory , for id of request
-        image_key = message_data.get("image_key")
-        if not image_key:
-            return {"statusCode": 400, "body": "Missing image_key"}
+    #image_key are mandatory , for id of request
+    image_key = message_data.get("image_key")
+    if not image_key:
+        logger.error(f"Missing image_key in message {record.get('messageId')}")
+        return True
+    received = job_event(message_data, "dispatch.received")
 
+    try:
+        payload = build_request_body(message_data)
+    except Exception as e:
+        logger.error(f"Failed to build request body for {image_key}: {e}")
         try:
+            update_queue_status(db, s3_object_id=image_key, status="FAILED")
+        except Exception as db_err:
+            logger.error(f"Status update failed after load_image error: {db_err}")
+        return True
+
+    try:
+        response, status_to_update, runpod_id = send_post_request_runpod(
+            secrets["runpod"]["api_url"], secrets["runpod"]["api_token"], payload
+        )
+        if response.status in (401, 403):
+            logger.info("RunPod rejected the token, refreshing secrets")
+            secrets = load_secrets(force=True)
+            # a streamed image is consumed by the first attempt
             payload = build_request_body(message_data)
-        except Exception as e:
-            try:
-                update_queue_status(
-                    db_config=load_secrets()["postgres"],
-                    s3_object_id=image_key,
-                    status="FAILED",
-                )
-            except Exception as db_err:
-                logger.error(f"Status update failed after load_image error: {db_err}")
-            return {"statusCode": 500, "body": str(e)}
-    
+            response, status_to_update, runpod_id = send_post_request_runpod(
+                secrets["runpod"]["api_url"], secrets["runpod"]["api_token"], payload
+            )
+    except Exception:
+        return False
+    if response.status == 429 or response.status >= 500:
+        logger.error(f"RunPod rejected {image_key} with status {response.status}, retrying")
+        return False
+    if events is not None and response.status < 300:
+        events += [received, job_event(message_data, "runpod.submitted")]
+
+    try:
+        update_queue_status(
+            db,
+            s3_object_id=image_key,
+            status=status_to_update,
+            runpod_id=runpod_id,
+        )
+        webhook_url = message_data.get("webhook")
+        if webhook_url:
+            send_post_request_webhook(webhook_url,status_to_update)
+    except Exception as db_err:
+        # RunPod already accepted the job, a redelivery would run it twice
+        logger.error(f"Final status update failed: {db_err}")
+    return True
+
+def lambda_handler(event, context):
+    global _cold_start
+    started = time.monotonic()
+    cold_start, _cold_start = _cold_start, False
+    logger.info(f"Received event: {json.dumps(event)}")
+    records = extract_records(event)
+    if not records:
+        return {"batchItemFailures": []}
+
+    try:
         secrets = load_secrets()
-        url = secrets["runpod"]["api_url"]
-        token = secrets["runpod"]["api_token"]
-        db_config = secrets["postgres"]
+    except Exception:
+        return {"batchItemFailures": [{"itemIdentifier": r.get("messageId")} for r in records]}
+    secrets_ms = (time.monotonic() - started) * 1000
 
+    events = []
 
-        response, status_to_update, runpod_id = send_post_request_runpod(
-            url, token, payload
-        )
-        body = response.data.decode("utf-8")
+    def safe_process(record):
         try:
-            update_queue_status(
-                db_config=db_config,
-                s3_object_id=image_key,
-                status=status_to_update,
-                runpod_id=runpod_id,
-            )
-            webhook_url = message_data.get("webhook")
-            if webhook_url:
-                send_post_request_webhook(webhook_url,status_to_update)
-        except Exception as db_err:
-            logger.error(f"Final status update failed: {db_err}")
-        return {
-            "statusCode": response.status,
-            "body": body
-        }
+            return process_record(record, secrets, _db, events)
+        except Exception as e:
+            logger.error(f"Unhandled error for message {record.get('messageId')}: {e}")
+            return False
 
-    except Exception as e:
-        logger.error(f"Unhandled error: {e}")
-        return {"statusCode": 500, "body": str(e)}
-            
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records))) as executor:
+        results = list(executor.map(safe_process, records))
+    record_job_events(_db, events)
+
+    failures = [{"itemIdentifier": record.get("messageId")} for record, ok in zip(records, results) if not ok]
+    logger.info(json.dumps({
+        "records": len(records),
+        "failed": len(failures),
+        "cold_start": cold_start,
+        "init_ms": round((started - _INIT_STARTED) * 1000, 1) if cold_start else 0,
+        "secrets_ms": round(secrets_ms, 1),
+        "duration_ms": round((time.monotonic() - started) * 1000, 1),
+    }))
+    return {"batchItemFailures": failures}
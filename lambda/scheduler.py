@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+class SchedulerClosed(Exception):
+    pass
+
+class FairScheduler:
+    # start-time fair queuing across users in front of one RunPod endpoint.
+    # Each user is a flow weighted by its tier; a job's tags are
+    #   start = max(virtual time, user's last finish), finish = start + cost / weight
+    # and the waiting job with the smallest finish tag gets the next free slot.
+    # Idle users restart from the virtual time, so they cannot bank credit.
+    def __init__(self, ceiling, tier_weights=None, default_weight=1.0):
+        self.ceiling = ceiling
+        self.tier_weights = tier_weights or {}
+        self.default_weight = default_weight
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.waiting = []
+        # slot (the key that acquired it) -> acquire time; a slot can carry
+        # several jobs when they are batched into one RunPod request
+        self.in_flight = {}
+        self.members = {}
+        self.slot_of = {}
+        self.waits = []
+        self.seq = itertools.count()
+        self.closed = False
+
+    def weight(self, tier):
+        return self.tier_weights.get(tier, self.default_weight) if tier else self.default_weight
+
+    # returns None when the job got a slot of its own, or the slot it was
+    # batched into by take()
+    async def acquire(self, key, user, tier=None, cost=1.0, group=None, data=None):
+        if self.closed:
+            raise SchedulerClosed()
+        start = max(self.virtual_time, self.finish_tags.get(user, 0.0))
+        finish = start + cost / self.weight(tier)
+        self.finish_tags[user] = finish
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (finish, next(self.seq), start, key, future, time.monotonic(), group, data))
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(key)
+            raise
+
+    def take(self, slot, group, limit):
+        # hands up to limit waiting jobs of the same group, in fair order, over
+        # to an already granted slot; returns their (key, data)
+        taken = []
+        if limit <= 0 or group is None:
+            return taken
+        kept = []
+        now = time.monotonic()
+        for entry in sorted(self.waiting):
+            _, _, start, key, future, enqueued, entry_group, data = entry
+            if future.done():
+                continue
+            if len(taken) < limit and entry_group == group:
+                self.virtual_time = max(self.virtual_time, start)
+                self.attach(key, slot)
+                self.waits.append(now - enqueued)
+                future.set_result(slot)
+                taken.append((key, data))
+            else:
+                kept.append(entry)
+        if taken:
+            self.waiting = kept
+            heapq.heapify(self.waiting)
+        return taken
+
+    def attach(self, key, slot):
+        self.slot_of[key] = slot
+        self.members[slot].add(key)
+
+    def release(self, key):
+        # the slot is freed once every job sharing it has finished
+        slot = self.slot_of.pop(key, None)
+        if slot is None:
+            return
+        members = self.members[slot]
+        members.discard(key)
+        if not members:
+            del self.members[slot]
+            del self.in_flight[slot]
+            self._dispatch()
+
+    def release_slot(self, slot):
+        for key in list(self.members.get(slot, ())):
+            self.release(key)
+
+    def jobs(self):
+        return list(self.slot_of)
+
+    def _dispatch(self):
+        while self.waiting and len(self.in_flight) < self.ceiling:
+            _, _, start, key, future, enqueued, _, _ = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            now = time.monotonic()
+            self.virtual_time = max(self.virtual_time, start)
+            self.in_flight[key] = now
+            self.members[key] = {key}
+            self.slot_of[key] = key
+            self.waits.append(now - enqueued)
+            future.set_result(None)
+        if len(self.finish_tags) > 4 * (len(self.waiting) + len(self.in_flight)) + 1024:
+            # flows that fell behind the virtual time carry no state worth keeping
+            self.finish_tags = {user: tag for user, tag in self.finish_tags.items() if tag > self.virtual_time}
+
+    def expired(self, max_age):
+        now = time.monotonic()
+        return [key for key, acquired in self.in_flight.items() if now - acquired > max_age]
+
+    def close(self):
+        # jobs still waiting are handed back so they can be redelivered
+        self.closed = True
+        for entry in self.waiting:
+            if not entry[4].done():
+                entry[4].set_exception(SchedulerClosed())
+        self.waiting = []
+
+    def stats(self):
+        waits, self.waits = sorted(self.waits), []
+        return {
+            "in_flight": len(self.in_flight),
+            "jobs_in_flight": len(self.slot_of),
+            "ceiling": self.ceiling,
+            "waiting": sum(1 for entry in self.waiting if not entry[4].done()),
+            "dispatched": len(waits),
+            "queue_wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else 0,
+            "queue_wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0,
+        }
@@ -1,6 +1,7 @@
 import base64
 import json
 import os
+import re
 import uuid
 
 import boto3
@@ -11,17 +12,42 @@ s3_client = boto3.client("s3")
 # Load bucket name from environment variable
 BUCKET_NAME = os.environ.get("S3_BUCKET_NAME", "satria-bucket")
 
+# presigned GET URLs handed to the worker stay valid this long
+PRESIGNED_URL_TTL = int(os.environ.get("PRESIGNED_URL_TTL", "900"))
+# multiple of 3 so every chunk base64-encodes without padding
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+IMAGE_MODE_BASE64 = "base64"
+IMAGE_MODE_URL = "url"
+
+class S3ImageSource:
+    # an opened S3 object that is base64-encoded while the request body is sent
+    def __init__(self, body):
+        self.body = body
+
+    def iter_base64(self):
+        pending = b""
+        try:
+            for chunk in self.body.iter_chunks(BASE64_CHUNK_SIZE):
+                pending += chunk
+                usable = len(pending) - len(pending) % 3
+                if usable:
+                    yield base64.b64encode(pending[:usable])
+                    pending = pending[usable:]
+            if pending:
+                yield base64.b64encode(pending)
+        finally:
+            self.body.close()
+
 def fetch_image_from_s3(bucket, key):
     try:
         logger.info(f"Fetching image from S3: bucket={bucket}, key={key}")
         response = s3_client.get_object(Bucket=bucket, Key=key)
-        image_bytes = response["Body"].read()
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-        logger.info(f"Successfully fetched and encoded image: {key}")
-        return image_base64
+        return S3ImageSource(response["Body"])
     except Exception as e:
         logger.error(f"Failed to fetch image from S3: {e}")
         raise
+
 def load_image(image_key):
     try:
         return fetch_image_from_s3(BUCKET_NAME, image_key)
@@ -29,56 +55,213 @@ def load_image(image_key):
         logger.error(f"Failed to load image from S3: {e}")
         raise
 
+def presign_image(image_key):
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": BUCKET_NAME, "Key": image_key},
+        ExpiresIn=PRESIGNED_URL_TTL,
+    )
+
+def encode_body(payload):
+    # returns (body, chunked); S3ImageSource values are streamed into the JSON
+    # instead of being read and encoded up front
+    sources = {}
+    nonce = uuid.uuid4().hex
+
+    def default(value):
+        if isinstance(value, S3ImageSource):
+            token = f"__image_{nonce}_{len(sources)}__"
+            sources[token] = value
+            return token
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    text = json.dumps(payload, default=default)
+    if not sources:
+        return text.encode("utf-8"), False
+    parts = re.split(f'"(__image_{nonce}_\\d+__)"', text)
+
+    def stream():
+        for i, part in enumerate(parts):
+            if i % 2:
+                yield b'"'
+                yield from sources[part].iter_base64()
+                yield b'"'
+            elif part:
+                yield part.encode("utf-8")
+    return stream(), True
+
+def is_link(value):
+    # links are [source_node_id, output_index]
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+class CompiledWorkflow:
+    def __init__(self, name, template, binding):
+        self.name = name
+        self.template = template
+        self.inputs = []
+        for field, spec in binding.get("inputs", {}).items():
+            self.inputs.append((field, self._path(spec["target"]), spec.get("required", False)))
+        image = binding.get("image")
+        self.image_path = self._path(image["target"]) if image else None
+        self.image_mode = image.get("mode", IMAGE_MODE_BASE64) if image else None
+        if self.image_mode not in (None, IMAGE_MODE_BASE64, IMAGE_MODE_URL):
+            raise ValueError(f"workflow {name}: unknown image mode {self.image_mode}")
+        self._validate()
+
+    def _path(self, target):
+        path = tuple(target.split("."))
+        node = self.template
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                raise ValueError(f"workflow {self.name}: binding target {target} not found in template")
+            node = node[key]
+        return path
+
+    def _validate(self):
+        for node_id, node in self.template.items():
+            if "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise ValueError(f"workflow {self.name}: node {node_id} needs class_type and inputs")
+            for value in node["inputs"].values():
+                if is_link(value) and value[0] not in self.template:
+                    raise ValueError(f"workflow {self.name}: node {node_id} links to missing node {value[0]}")
+
+    def render(self, values):
+        # copy-on-write along the patched paths only; untouched nodes are shared
+        # with the template, which is never mutated
+        workflow = dict(self.template)
+        copied = set()
+        for path, value in values:
+            parent = workflow
+            for key in path[:-1]:
+                child = parent[key]
+                if id(child) not in copied:
+                    child = dict(child)
+                    parent[key] = child
+                    copied.add(id(child))
+                parent = child
+            parent[path[-1]] = value
+        return workflow
+
+    def build(self, message_data, image_name):
+        values = []
+        for field, path, required in self.inputs:
+            value = message_data.get(field)
+            if value is None:
+                if required:
+                    logger.error(f"Missing {field} in message: {message_data}")
+                    raise ValueError(f"missing {field}")
+                continue
+            values.append((path, value))
+        if self.image_path:
+            values.append((self.image_path, image_name))
+        return self.render(values)
+
+def load_registry(directory):
+    registry = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json") or filename.endswith(".binding.json"):
+            continue
+        name = filename[:-len(".json")]
+        with open(os.path.join(directory, filename)) as f:
+            template = json.load(f)
+        binding_file = os.path.join(directory, f"{name}.binding.json")
+        if not os.path.exists(binding_file):
+            raise ValueError(f"workflow {name}: missing {name}.binding.json")
+        with open(binding_file) as f:
+            binding = json.load(f)
+        registry[name] = CompiledWorkflow(name, template, binding)
+    return registry
+
+# every template is parsed and validated once per container, at cold start
+WORKFLOWS_DIR = os.path.join(os.path.dirname(__file__), "workflows")
+DEFAULT_WORKFLOW = "img2img_flux"
+registry = load_registry(WORKFLOWS_DIR)
+
 def build_request_body(message_data):
-    workflow_name = message_data.get("workflow_name")
-    try:
-        match workflow_name:
-            case None | "img2img_flux":
-                return img2img_flux(message_data)
-            case "workflow_a":
-                return {"workflow": "A", "details": "Specific config for A"}
-            case "workflow_b":
-                return {"workflow": "B", "details": "Specific config for B"}
-            case _:
-                raise ValueError(f"Unknown workflow: {workflow_name}")
-    except Exception as e:
-        raise
-        
-def img2img_flux(message_data):
+    workflow_name = message_data.get("workflow_name") or DEFAULT_WORKFLOW
+    compiled = registry.get(workflow_name)
+    if compiled is None:
+        raise ValueError(f"Unknown workflow: {workflow_name}")
+
     #validate message_data
     image_key = message_data.get("image_key")
-    prompt = message_data.get("prompt")
     webhook_url = message_data.get("webhook")
-    if not prompt:
-        logger.error(f"Missing prompt in message: {message_data}")
-        raise ValueError("missing image_key or prompt")
     if not webhook_url:
         logger.error(f"Missing webhook in message: {message_data}")
         raise ValueError("missing webhook")
 
-    try:
-        image_base64 = load_image(image_key)
-    except Exception as e:
-        raise
-
     unique_name = f"{uuid.uuid4().hex}.png"
+    workflow = compiled.build(message_data, unique_name)
 
-    with open(os.path.join(os.path.dirname(__file__), "img2img_flux.json")) as f:
-        workflow = json.load(f)
-
-    workflow["6"]["inputs"]["text"] = prompt
-    workflow["82"] = {"inputs": {"image": unique_name}, "class_type": "LoadImage", "_meta": {"title": "Load Image"}}
+    images = []
+    if compiled.image_mode == IMAGE_MODE_URL:
+        # the worker downloads the input itself; nothing is buffered here
+        images.append({
+            "name": unique_name,
+            "url": presign_image(image_key)
+        })
+    elif compiled.image_path:
+        images.append({
+            "name": unique_name,
+            "image": load_image(image_key)
+        })
 
     body = {
         "webhook": webhook_url,
         "input": {
-            "images": [
-                {
-                    "name": unique_name,
-                    "image": image_base64
-                }
-            ],
+            "images": images,
             "workflow": workflow
         }
     }
-    return body
\ No newline at end of file
+    return body
+
+def merge_workflows(workflows):
+    # workflows rendered from one template become a single graph. A node that is
+    # identical in every copy and only depends on such nodes (model loaders,
+    # samplers, schedulers) is kept once under its own id; the rest is copied
+    # per job as "<index>_<node id>" with its links renamed.
+    first = workflows[0]
+    shared = set()
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in first.items():
+            if node_id in shared or any(w.get(node_id) != node for w in workflows[1:]):
+                continue
+            if all(value[0] in shared for value in node["inputs"].values() if is_link(value)):
+                shared.add(node_id)
+                changed = True
+
+    merged = {node_id: first[node_id] for node_id in shared}
+    for i, workflow in enumerate(workflows):
+        def rename(node_id):
+            return node_id if node_id in shared else f"{i}_{node_id}"
+        for node_id, node in workflow.items():
+            if node_id in shared:
+                continue
+            inputs = {key: [rename(value[0]), value[1]] if is_link(value) else value
+                      for key, value in node["inputs"].items()}
+            merged[rename(node_id)] = {**node, "inputs": inputs}
+    return merged
+
+def build_batch_request_body(jobs):
+    # jobs are (image_key, body) pairs from build_request_body for the same
+    # workflow. Each job's images are saved under its image_key so the result
+    # can be told apart; there is no webhook, the batch is followed by polling.
+    if len(jobs) == 1:
+        return jobs[0][1]
+    images = []
+    workflows = []
+    for image_key, body in jobs:
+        images.extend(body["input"]["images"])
+        workflow = dict(body["input"]["workflow"])
+        for node_id, node in workflow.items():
+            if node.get("class_type") == "SaveImage":
+                workflow[node_id] = {**node, "inputs": {**node["inputs"], "filename_prefix": image_key}}
+        workflows.append(workflow)
+    return {
+        "input": {
+            "images": images,
+            "workflow": merge_workflows(workflows)
+        }
+    }
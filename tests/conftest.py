@@ -0,0 +1,22 @@
+import os
+
+# tests never talk to real services; give Settings something to load
+for name, value in {
+    "JWT_SECRET": "test-secret",
+    "CORS_ORIGINS": '["*"]',
+    "S3_REGION": "us-east-1",
+    "S3_BUCKET_NAME": "test-bucket",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "DB_SCHEMA": "postgres",
+    "DB_USER": "postgres",
+    "DB_PASSWORD": "postgres",
+    "SQS_REGION": "us-east-1",
+    "SQS_URL": "http://localhost/queue",
+    "RUNPOD_URL": "http://localhost/runpod",
+    "RUNPOD_SECRET": "test",
+    "SIGNATURE_SECRET": "test",
+    "APP_BASE_URL": "http://localhost",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,74 @@
+import os
+import statistics
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api import metrics
+from api.metrics import HTTP_FAMILY, render_prometheus, timed
+from api.middleware.metrics import MetricsMiddleware
+
+# allowed extra microseconds per request for the middleware and two stage
+# timers; raise it on a slow or shared CI runner
+METRICS_OVERHEAD_BUDGET = float(os.environ.get("METRICS_OVERHEAD_BUDGET", "50"))
+SCRAPE_BUDGET_MS = 50.0
+
+
+def build_app(instrumented):
+    app = FastAPI()
+
+    @app.get("/status/{id}")
+    async def status(id: str):
+        if instrumented:
+            # a request in new_queue/get_latest_status goes through a few stages
+            with timed("test.db"):
+                pass
+            with timed("test.cache"):
+                pass
+        return {"id": id, "status": "IN_QUEUE"}
+
+    if instrumented:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+
+def request_time(client, i):
+    start = time.perf_counter()
+    response = client.get(f"/status/job-{i}")
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    return elapsed
+
+
+def test_middleware_records_route_template():
+    with TestClient(build_app(True)) as client:
+        client.get("/status/job-1")
+        client.get("/status/job-2")
+    labels = (("method", "GET"), ("route", "/status/{id}"), ("status", "200"))
+    assert (HTTP_FAMILY, labels) in metrics.latencies
+    assert 'route="/status/{id}"' in render_prometheus()
+
+
+def test_hot_path_overhead_within_budget():
+    with TestClient(build_app(False)) as plain, TestClient(build_app(True)) as instrumented:
+        for i in range(200):
+            request_time(plain, i)
+            request_time(instrumented, i)
+        # interleaved so drift in machine load hits both equally; medians so
+        # the odd scheduling stall does not count
+        base, measured = [], []
+        for i in range(2000):
+            pair = (plain, instrumented) if i % 2 else (instrumented, plain)
+            for client in pair:
+                (base if client is plain else measured).append(request_time(client, i))
+    overhead_us = (statistics.median(measured) - statistics.median(base)) * 1e6
+    assert overhead_us < METRICS_OVERHEAD_BUDGET, f"{overhead_us:.1f} us per request"
+
+
+def test_render_within_budget():
+    for n in range(40):
+        metrics.latency(f"test.stage{n}").observe(0.01)
+    start = time.perf_counter()
+    render_prometheus()
+    assert (time.perf_counter() - start) * 1000 < SCRAPE_BUDGET_MS